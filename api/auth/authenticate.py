@@ -1,14 +1,32 @@
+import logging
+import time
+
+from bson import ObjectId
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from starlette import status
 
 from api.auth.hash_password import HashPassword
 from api.auth.jwt_handler import verify_access_token
-from api.database.connection import users_collection
-from api.model.user import Users
+from api.auth.token_revocation import token_revocations
+from api.auth.user_cache import UserCache
+from api.database.connection import users_collection, Settings
+from api.database.job_queue import job_queue, JobQueueFull
+from api.utils.instrumentation import record_phase
+from api.utils.metrics import registry
 
+logger = logging.getLogger(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 hash_password=HashPassword()
+setting=Settings()
+user_cache=UserCache(setting.user_cache_size,setting.user_cache_ttl)
+registry.gauges("user_cache","Authenticated user cache",user_cache.stats)
+password_rehashes=registry.counter("password_rehashes_total","Stored password hashes upgraded on login",("result",))
+# claims: authorize from the token alone, database: read the user on every request (through user_cache)
+AUTH_MODE_CLAIMS="claims"
+AUTH_MODE_DATABASE="database"
+
+
 async def authenticate(token:str=Depends(oauth2_scheme)):
     if not token:
         raise HTTPException(
@@ -16,9 +34,31 @@ async def authenticate(token:str=Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    started=time.perf_counter()
     decoded_token=verify_access_token(token)
-    user = await get_user(str(decoded_token["sub"]))
-    if not user:
+    record_phase("jwt_verify",time.perf_counter()-started)
+    token_version=decoded_token.get("ver",0)
+    user_id=decoded_token.get("uid")
+    if user_id and token_revocations.is_revoked(user_id,token_version):
+        raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    if setting.auth_mode==AUTH_MODE_CLAIMS and user_id and decoded_token.get("user_type"):
+        # tokens issued before uid and user_type were embedded still go through the database
+        return {
+            "_id":ObjectId(user_id),
+            "username":str(decoded_token["sub"]),
+            "user_type":decoded_token["user_type"]
+        }
+    username=str(decoded_token["sub"])
+    user=user_cache.get(username)
+    if user is None:
+        user = await get_user(username)
+        if user:
+            user_cache.set(username,user)
+    if not user or user.get("token_version",0)!=token_version:
         raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -35,6 +75,21 @@ async def authenticate_user(username: str, password: str) -> object:
     user: object =await  get_user(username)
     if not user:
         return None
-    if not hash_password.verify_password(password, user.get("password")):
+    if not await hash_password.verify_password_async(password, user.get("password")):
         return None
-    return user
\ No newline at end of file
+    if setting.password_rehash and hash_password.needs_update(user.get("password")):
+        try:
+            await job_queue.enqueue("rehash_password",user_id=user["_id"],stored_hash=user.get("password"),
+                                    password=password)
+        except JobQueueFull:
+            # the next login tries again
+            logger.warning("Job queue is full, password of %s is not rehashed",user.get("username"))
+    return user
+
+
+@job_queue.task("rehash_password",durable=False)
+async def rehash_password(user_id,stored_hash:str,password:str):
+    """Stores password hashed with the current scheme and cost, unless the stored hash changed since it was read"""
+    hashed=await hash_password.create_password_hash_async(password)
+    result=await users_collection.update_one({"_id":user_id,"password":stored_hash},{"$set":{"password":hashed}})
+    password_rehashes.inc(result="upgraded" if result.modified_count else "skipped")
\ No newline at end of file
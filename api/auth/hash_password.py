@@ -1,6 +1,117 @@
+import functools
+import logging
+import os
+import time
+
 from passlib.context import CryptContext
+from passlib.hash import argon2, bcrypt
+
+from api.auth.hash_pool import HashWorkerPool, ProcessHashPool
+from api.database.connection import Settings
+from api.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+BENCHMARK_PASSWORD = "benchmark password"
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
+ARGON2_MAX_TIME_COST = 10
+SCHEMES = {"bcrypt": bcrypt, "argon2": argon2}
+
+
+def password_context_config(bcrypt_rounds: int, argon2_time_cost: int, fixed: bool) -> dict:
+    """CryptContext settings hashing with password_scheme. Hashes of the other scheme still verify and, like
+    hashes below the configured cost, are reported by needs_update. A fixed cost also flags stronger hashes."""
+    schemes = [setting.password_scheme] + [name for name, handler in SCHEMES.items()
+                                           if name != setting.password_scheme and handler.has_backend()]
+    config = {
+        "schemes": schemes,
+        "default": setting.password_scheme,
+        "deprecated": "auto",
+        "bcrypt__default_rounds": bcrypt_rounds,
+        "bcrypt__min_rounds": bcrypt_rounds
+    }
+    if fixed:
+        config["bcrypt__max_rounds"] = bcrypt_rounds
+    if "argon2" in schemes:
+        config.update({
+            "argon2__type": "ID",
+            "argon2__memory_cost": setting.argon2_memory_cost,
+            "argon2__parallelism": setting.argon2_parallelism,
+            "argon2__default_rounds": argon2_time_cost,
+            "argon2__min_rounds": argon2_time_cost
+        })
+        if fixed:
+            config["argon2__max_rounds"] = argon2_time_cost
+    return config
+
+
+def _seconds_per_hash(handler) -> float:
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        handler.hash(BENCHMARK_PASSWORD)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def tune_bcrypt_rounds(target_seconds: float) -> int:
+    """Highest bcrypt cost whose hash takes at most target_seconds here, each round doubles the work"""
+    rounds = BCRYPT_MIN_ROUNDS
+    seconds = _seconds_per_hash(bcrypt.using(rounds=rounds))
+    while rounds < BCRYPT_MAX_ROUNDS and seconds * 2 <= target_seconds:
+        rounds += 1
+        seconds *= 2
+    return rounds
+
+
+def tune_argon2_time_cost(target_seconds: float) -> int:
+    """Highest argon2id time cost at the configured memory cost whose hash takes at most target_seconds here"""
+    seconds = _seconds_per_hash(argon2.using(type="ID", memory_cost=setting.argon2_memory_cost,
+                                             parallelism=setting.argon2_parallelism, rounds=1))
+    return max(1, min(ARGON2_MAX_TIME_COST, int(target_seconds // seconds)))
+
+
+pwd_context = CryptContext(**password_context_config(setting.bcrypt_rounds, setting.argon2_time_cost, fixed=True))
+
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def configure_password_hashing():
+    """Benchmarks the host and loads the cost meeting password_hash_target_ms into pwd_context.
+    Tuned costs only flag weaker hashes for rehash, so hosts that tune differently don't undo each other."""
+    if not setting.password_hash_target_ms:
+        return
+    target_seconds = setting.password_hash_target_ms / 1000
+    if setting.password_scheme == "argon2":
+        bcrypt_rounds, argon2_time_cost = setting.bcrypt_rounds, tune_argon2_time_cost(target_seconds)
+    else:
+        bcrypt_rounds, argon2_time_cost = tune_bcrypt_rounds(target_seconds), setting.argon2_time_cost
+    pwd_context.load(password_context_config(bcrypt_rounds, argon2_time_cost, fixed=False))
+    logger.info("Password hashing tuned for %s ms: scheme %s, bcrypt rounds %s, argon2 time cost %s",
+                setting.password_hash_target_ms, setting.password_scheme, bcrypt_rounds, argon2_time_cost)
+
+
+hash_pool = HashWorkerPool(max_workers=setting.hash_pool_workers or min(4, os.cpu_count() or 1),
+                           max_queue=setting.hash_pool_queue)
+registry.gauges("password_hash_pool", "Password hashing pool", hash_pool.stats)
+
+
+@functools.lru_cache(maxsize=4)
+def _context_of(config: str) -> CryptContext:
+    return CryptContext.from_string(config)
+
+
+def hash_passwords(passwords: list, config: str) -> list:
+    # runs in a worker process, which doesn't see the tuning done in the app process
+    context = _context_of(config)
+    return [context.hash(password) for password in passwords]
+
+
+bulk_hash_pool = ProcessHashPool(hash_passwords, processes=setting.bulk_hash_processes or os.cpu_count() or 1)
+
+
+def shutdown_hash_pools():
+    hash_pool.shutdown()
+    bulk_hash_pool.shutdown()
 
 
 class HashPassword:
@@ -11,3 +122,14 @@ class HashPassword:
     def create_password_hash(self,password:str):
         return pwd_context.hash(password)
 
+    def needs_update(self, hashed_password: str) -> bool:
+        return pwd_context.needs_update(hashed_password)
+
+    async def verify_password_async(self, plain_password: str, hashed_password: str):
+        return await hash_pool.run(self.verify_password, plain_password, hashed_password)
+
+    async def create_password_hash_async(self, password: str):
+        return await hash_pool.run(self.create_password_hash, password)
+
+    async def create_password_hashes(self, passwords: list) -> list:
+        return await bulk_hash_pool.map(passwords, pwd_context.to_string())
@@ -0,0 +1,106 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+from api.utils.instrumentation import record_phase
+
+
+class HashWorkerPool:
+    """Runs password hashing off the event loop on a fixed number of threads.
+    At most max_queue calls may wait for a thread, further calls are rejected with 503."""
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    async def run(self, func, *args):
+        if self._in_flight >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self._in_flight += 1
+        submitted = time.perf_counter()
+
+        def timed_call():
+            started = time.perf_counter()
+            result = func(*args)
+            return result, started - submitted, time.perf_counter() - started
+
+        try:
+            result, queue_wait, hash_time = await asyncio.get_running_loop().run_in_executor(
+                self._executor, timed_call)
+        finally:
+            self._in_flight -= 1
+        self.completed += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.hash_time_total += hash_time
+        self.hash_time_max = max(self.hash_time_max, hash_time)
+        record_phase("password_hash_queue", queue_wait)
+        record_phase("password_hash", hash_time)
+        return result
+
+    def queue_depth(self) -> int:
+        return max(self._in_flight - self.max_workers, 0)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth(),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_seconds_total": self.queue_wait_total,
+            "queue_wait_seconds_max": self.queue_wait_max,
+            "hash_seconds_total": self.hash_time_total,
+            "hash_seconds_max": self.hash_time_max
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class ProcessHashPool:
+    """Spreads a list of passwords over worker processes, for bulk work where one thread per hash is too slow.
+    func must be a module level function that takes a list of passwords, then the extra arguments given to map,
+    and returns their hashes in order.
+    The processes are started on first use."""
+
+    def __init__(self, func: Callable[[list], list], processes: int):
+        self.func = func
+        self.processes = processes
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def map(self, passwords: list, *args) -> list:
+        if not passwords:
+            return []
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        chunk_size = -(-len(passwords) // self.processes)
+        loop = asyncio.get_running_loop()
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(self._executor, self.func, passwords[start:start + chunk_size], *args)
+            for start in range(0, len(passwords), chunk_size)
+        ))
+        return [hashed for chunk in chunks for hashed in chunk]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -1,12 +1,69 @@
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+from typing import Optional
 
 from fastapi import HTTPException, Depends
 from starlette import status
 
 from api.database.connection import Settings
+from api.utils.metrics import registry
 from jose import jwt, JWTError
 setting=Settings()
 
+
+class VerifiedTokenCache:
+    """Bounded LRU of tokens whose signature was already verified, each kept until the token expires"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, token: str) -> Optional[dict]:
+        payload = self._entries.get(token)
+        if payload is None:
+            self.misses += 1
+            return None
+        if time.time() > payload["exp"]:
+            del self._entries[token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return payload
+
+    def set(self, token: str, payload: dict):
+        if self.max_size <= 0:
+            return
+        self._entries[token] = payload
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+verified_tokens=VerifiedTokenCache(setting.verified_token_cache_size)
+registry.gauges("verified_token_cache","Verified access token cache",verified_tokens.stats)
+
+
+def token_claims(user: dict) -> dict:
+    """Claims identifying user in its access token, enough to authorize a request without reading the user"""
+    return {
+        "sub": user.get("username"),
+        "uid": str(user.get("_id")),
+        "user_type": user.get("user_type"),
+        "ver": user.get("token_version", 0)
+    }
+
+
 def create_access_token(user: dict):
     expires_delta = timedelta(minutes=45)
     to_encode = user.copy()
@@ -22,6 +79,9 @@ def verify_access_token(token: str):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, setting.secret_key, algorithms=[setting.algorithm])
         username= str(payload.get("sub"))
@@ -30,6 +90,7 @@ def verify_access_token(token: str):
             raise credentials_exception
         if datetime.utcnow().timestamp()> expire:
             raise credentials_exception
+        verified_tokens.set(token, payload)
         return payload
     except JWTError:
-        raise credentials_exception
\ No newline at end of file
+        raise credentials_exception
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from api.database.connection import users_collection, Settings
+from api.utils.metrics import registry
+from api.utils.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+
+class TokenRevocations:
+    """Current token version of every user whose tokens were revoked. Tokens carrying an older version are rejected.
+    Bumps made by other workers are picked up by polling token_version_ts every poll_interval seconds."""
+
+    def __init__(self, collection, poll_interval: float):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.versions: Dict[str, int] = {}
+        self.since = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def revoke(self, user_id: str, version: int):
+        if version > self.versions.get(user_id, 0):
+            self.versions[user_id] = version
+
+    def is_revoked(self, user_id: str, version: int) -> bool:
+        return version < self.versions.get(user_id, 0)
+
+    async def poll(self):
+        # $gte re-reads the users bumped in the same millisecond as the last one seen, which is harmless
+        async for user in self.collection.find({"token_version_ts": {"$gte": self.since}},
+                                               {"token_version": 1, "token_version_ts": 1}):
+            self.revoke(str(user["_id"]), user.get("token_version", 0))
+            self.since = max(self.since, user["token_version_ts"])
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except PyMongoError as error:
+                logger.warning("Could not poll token revocations: %s", error)
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "revoked_users": len(self.versions)
+        }
+
+
+token_revocations = TokenRevocations(users_collection, setting.token_revocation_poll_seconds)
+registry.gauges("token_revocations", "Access token revocations", token_revocations.stats)
+
+
+async def revoke_tokens(user_id: ObjectId, changes: dict) -> Optional[dict]:
+    """Applies changes to the user and bumps its token version in the same update,
+    which revokes every access token issued to the user before"""
+    user = await users_collection.find_one_and_update(
+        {"_id": ObjectId(user_id)},
+        {"$set": {**changes, "token_version_ts": get_timestamp()}, "$inc": {"token_version": 1}},
+        projection={"token_version": 1},
+        return_document=ReturnDocument.AFTER)
+    if user:
+        token_revocations.revoke(str(user["_id"]), user["token_version"])
+    return user
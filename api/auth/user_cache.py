@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class UserCache:
+    """Bounded LRU of user documents keyed by username, each entry expiring after ttl seconds"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, username: str) -> Optional[dict]:
+        entry = self._entries.get(username)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user = entry
+        if time.monotonic() > expires_at:
+            del self._entries[username]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(username)
+        self.hits += 1
+        return user
+
+    def set(self, username: str, user: dict):
+        if self.max_size <= 0:
+            return
+        self._entries[username] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        self._entries.pop(username, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
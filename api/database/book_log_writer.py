@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from typing import Optional
+
+from bson import ObjectId
+from pymongo.errors import PyMongoError, BulkWriteError
+
+from api.database.connection import book_logs_collection, Settings
+from api.database.job_queue import job_queue, JobQueueFull
+from api.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+
+class BufferedLogWriter:
+    """Collects ledger events in memory and hands them over in batches, once batch_size events are pending or
+    flush_interval seconds have passed, so appending an event costs the request no round trip. With a job_name,
+    a batch is queued as one job, kept in the jobs collection with job_queue_backend=mongo, whose handler writes it
+    with one unordered insert_many. A batch that can't be queued, or every batch without a job_name, is written
+    right away. Events get their _id when appended, so a batch written twice only fails on duplicates."""
+
+    def __init__(self, collection, batch_size: int, flush_interval: float, max_pending: int,
+                 job_name: Optional[str] = None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.job_name = job_name
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def append(self, event: dict):
+        self._pending.append({"_id": ObjectId(), **event})
+        if len(self._pending) > self.max_pending:
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.dropped += overflow
+            logger.error("Book log buffer is full, dropped %s events", overflow)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def write(self, batch: list):
+        """Inserts batch, events written by an earlier attempt are skipped"""
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            self.written += len(batch)
+        except BulkWriteError as error:
+            failed = [x for x in error.details["writeErrors"] if x.get("code") != 11000]
+            self.written += len(batch) - len(failed)
+            if failed:
+                raise
+
+    async def flush(self):
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:len(batch)]
+            if self.job_name:
+                try:
+                    await job_queue.enqueue(self.job_name, events=batch)
+                    self.queued += len(batch)
+                    continue
+                except (JobQueueFull, PyMongoError) as error:
+                    logger.warning("Could not queue %s book log events, writing them: %s", len(batch), error)
+            try:
+                await self.write(batch)
+            except BulkWriteError as error:
+                failed = [x for x in error.details["writeErrors"] if x.get("code") != 11000]
+                self.dropped += len(failed)
+                logger.error("Could not write %s book log events: %s", len(failed), failed[0].get("errmsg"))
+            except PyMongoError as error:
+                logger.error("Could not write %s book log events, will retry: %s", len(batch), error)
+                self._pending[:0] = batch
+                return
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes the pending events, before the job queue stops so that it still runs their jobs"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+
+book_log_writer = BufferedLogWriter(book_logs_collection,
+                                    batch_size=setting.book_log_batch_size,
+                                    flush_interval=setting.book_log_flush_interval,
+                                    max_pending=setting.book_log_max_pending,
+                                    job_name="record_book_events")
+registry.gauges("book_log_writer", "Buffered book log writer", book_log_writer.stats)
+
+
+@job_queue.task("record_book_events")
+async def record_book_events(events: list):
+    await book_log_writer.write(events)
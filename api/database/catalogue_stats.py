@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from typing import Optional
+
+from pymongo import DeleteMany, UpdateOne
+from pymongo.errors import PyMongoError
+
+from api.database.connection import books_collection, users_collection, loans_collection, stats_collection, Settings
+from api.database.job_queue import job_queue, JobQueueFull
+from api.model.book import BookStatus
+from api.model.loan import LoanStatus
+from api.utils.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+# counters are documents {dimension, value, count}, e.g. {"dimension": "genre", "value": "Fantasy", "count": 12}
+STATUS = "status"
+GENRE = "genre"
+AUTHOR = "author"
+USERS = "users"
+COPIES = "copies"
+LOANS = "loans"
+OVERDUE = "OVERDUE"
+
+
+def book_increments(book: dict, delta: int) -> list:
+    """Counter changes of adding (delta 1) or removing (delta -1) book from the catalogue"""
+    available = book.get("available_copies", 1)
+    return [
+        [STATUS, book.get("status") or BookStatus.available.value, delta],
+        [GENRE, book.get("genre"), delta],
+        [AUTHOR, book.get("author"), delta],
+        [COPIES, BookStatus.available.value, available * delta],
+        [COPIES, BookStatus.borrowed.value, (book.get("total_copies", 1) - available) * delta],
+    ]
+
+
+def copies_increments(borrowed: int) -> list:
+    """Counter changes of lending (borrowed 1) or getting back (borrowed -1) a copy"""
+    return [[COPIES, BookStatus.available.value, -borrowed], [COPIES, BookStatus.borrowed.value, borrowed]]
+
+
+def status_increments(old_status: str, new_status: str) -> list:
+    return [[STATUS, old_status, -1], [STATUS, new_status, 1]]
+
+
+def user_increments(user_type: str, delta: int) -> list:
+    return [[USERS, user_type, delta]]
+
+
+def overdue_increments(delta: int) -> list:
+    """Counter change of flagging (delta > 0) or returning (delta -1) overdue loans"""
+    return [[LOANS, OVERDUE, delta]]
+
+
+async def record_stats(increments: list):
+    """Applies the counter changes in the background, a periodic rebuild corrects whatever gets lost"""
+    if not increments:
+        return
+    try:
+        await job_queue.enqueue("update_stats", increments=increments)
+    except (JobQueueFull, PyMongoError) as error:
+        logger.warning("Could not queue %s statistics changes: %s", len(increments), error)
+
+
+@job_queue.task("update_stats")
+async def update_stats(increments: list):
+    merged = {}
+    for dimension, value, delta in increments:
+        merged[(dimension, value)] = merged.get((dimension, value), 0) + delta
+    operations = [UpdateOne({"dimension": dimension, "value": value}, {"$inc": {"count": delta}}, upsert=True)
+                  for (dimension, value), delta in merged.items() if delta]
+    if operations:
+        await stats_collection.bulk_write(operations, ordered=False)
+
+
+async def rebuild_stats():
+    """Recomputes every counter from the books, users and loans collections. Changes applied while it runs can be
+    overwritten, the next rebuild corrects them."""
+    counts = {}
+    for dimension, expression in ((STATUS, {"$ifNull": ["$status", BookStatus.available.value]}),
+                                  (GENRE, "$genre"),
+                                  (AUTHOR, "$author")):
+        async for group in books_collection.aggregate([
+            {"$match": {"is_deleted": False}},
+            {"$group": {"_id": expression, "count": {"$sum": 1}}}
+        ]):
+            counts[(dimension, group["_id"])] = group["count"]
+    async for group in books_collection.aggregate([
+        {"$match": {"is_deleted": False}},
+        {"$group": {"_id": None,
+                    "available": {"$sum": {"$ifNull": ["$available_copies", 1]}},
+                    "total": {"$sum": {"$ifNull": ["$total_copies", 1]}}}}
+    ]):
+        counts[(COPIES, BookStatus.available.value)] = group["available"]
+        counts[(COPIES, BookStatus.borrowed.value)] = group["total"] - group["available"]
+    async for group in users_collection.aggregate([
+        {"$match": {"is_deleted": False}},
+        {"$group": {"_id": "$user_type", "count": {"$sum": 1}}}
+    ]):
+        counts[(USERS, group["_id"])] = group["count"]
+    counts[(LOANS, OVERDUE)] = await loans_collection.count_documents(
+        {"status": LoanStatus.active, "overdue_ts": {"$exists": True}})
+    rebuilt_ts = get_timestamp()
+    operations = [UpdateOne({"dimension": dimension, "value": value},
+                            {"$set": {"count": count, "rebuilt_ts": rebuilt_ts}}, upsert=True)
+                  for (dimension, value), count in counts.items()]
+    # counters of values that no longer occur
+    operations.append(DeleteMany({"rebuilt_ts": {"$lt": rebuilt_ts}}))
+    await stats_collection.bulk_write(operations, ordered=True)
+    logger.info("Rebuilt catalogue statistics, %s counters", len(counts))
+
+
+class StatsRebuilder:
+    """Rebuilds the counters when there are none yet, then every interval seconds (never when 0)"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        try:
+            if await stats_collection.find_one({}, {"_id": 1}) is None:
+                await rebuild_stats()
+        except PyMongoError as error:
+            logger.error("Could not build catalogue statistics: %s", error)
+        while self.interval:
+            await asyncio.sleep(self.interval)
+            try:
+                await rebuild_stats()
+            except PyMongoError as error:
+                logger.error("Could not rebuild catalogue statistics: %s", error)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+stats_rebuilder = StatsRebuilder(setting.stats_rebuild_interval)
@@ -1,28 +1,209 @@
-import os
-from typing import Optional, Any
+import asyncio
+import logging
+from typing import Optional, Any, Dict
 
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from pydantic.v1 import BaseSettings
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import Primary, SecondaryPreferred
 
+from api.utils.instrumentation import command_listener
 
-MONGODB_URL = os.getenv("database_url")
-DB_NAME = os.getenv("database_name")
-client =AsyncIOMotorClient(MONGODB_URL)
-db = client[DB_NAME]
+logger = logging.getLogger(__name__)
 
-users_collection = db["users"]
-books_collection =db["books"]
-book_logs_collection=db["book_logs"]
 
 class Settings(BaseSettings):
     secret_key:Optional[str]=None
     algorithm:Optional[str]=None
+    database_url:Optional[str]=None
+    database_name:Optional[str]=None
+    mongo_max_pool_size:int=100
+    mongo_min_pool_size:int=0
+    mongo_wait_queue_timeout_ms:Optional[int]=None
+    mongo_compressors:Optional[str]=None
+    mongo_read_preference:str="primary"
+    mongo_prewarm:bool=True
+    # unset: detected from the server, transactions need a replica set or a sharded cluster
+    mongo_transactions:Optional[bool]=None
+    read_replica_max_staleness_seconds:int=90
+    read_routing:Dict[str,str]={}
+    user_cache_size:int=1024
+    user_cache_ttl:float=60
+    hash_pool_workers:Optional[int]=None
+    hash_pool_queue:int=64
+    bulk_hash_processes:Optional[int]=None
+    ensure_indexes:bool=True
+    book_log_batch_size:int=500
+    book_log_flush_interval:float=0.5
+    book_log_max_pending:int=100000
+    slow_request_ms:float=0
+    catalogue_version_refresh_seconds:float=1
+    response_cache_backend:str="none"
+    response_cache_url:Optional[str]=None
+    response_cache_max_entries:int=10000
+    response_cache_ttl:float=30
+    response_cache_ttls:Dict[str,float]={}
+    response_cache_change_stream:bool=False
+    auth_mode:str="database"
+    verified_token_cache_size:int=4096
+    token_revocation_poll_seconds:float=5
+    rate_limit_backend:str="memory"
+    rate_limit_url:Optional[str]=None
+    rate_limit_max_keys:int=100000
+    rate_limits:Dict[str,str]={"POST /login":"ip:20/60,username:10/300","POST /signup":"ip:5/60,username:3/300"}
+    rate_limit_trust_forwarded:bool=False
+    password_scheme:str="bcrypt"
+    password_hash_target_ms:float=0
+    bcrypt_rounds:int=12
+    argon2_memory_cost:int=65536
+    argon2_time_cost:int=3
+    argon2_parallelism:int=2
+    password_rehash:bool=True
+    job_queue_backend:str="memory"
+    job_queue_concurrency:int=4
+    job_queue_max_attempts:int=5
+    job_queue_retry_delay:float=1
+    job_queue_poll_interval:float=1
+    job_queue_max_pending:int=10000
+    job_queue_lease_seconds:float=300
+    job_queue_drain_timeout:float=10
+    stats_rebuild_interval:float=3600
+    loan_period_days:int=14
+    overdue_sweep_interval:float=300
+    overdue_sweep_batch_size:int=500
+    overdue_fine_per_day:float=0.5
+    copies_reconcile_interval:float=600
+    book_events_buffer_size:int=100
+    book_events_max_clients:int=10000
+    book_events_keepalive:float=15
+    migrate_on_startup:bool=True
 
     class config:
         env_file=".env"
 
 
+setting=Settings()
+client:Optional[AsyncIOMotorClient]=None
+_transactions:Dict[int,bool]={}
 
 
+def create_client()->AsyncIOMotorClient:
+    options={
+        "maxPoolSize":setting.mongo_max_pool_size,
+        "minPoolSize":setting.mongo_min_pool_size,
+        "readPreference":setting.mongo_read_preference,
+        "event_listeners":[command_listener]
+    }
+    if setting.mongo_wait_queue_timeout_ms:
+        options["waitQueueTimeoutMS"]=setting.mongo_wait_queue_timeout_ms
+    if setting.mongo_compressors:
+        # zstd needs the zstandard package and snappy python-snappy, pymongo skips the ones it can't load
+        options["compressors"]=setting.mongo_compressors
+    return AsyncIOMotorClient(setting.database_url,**options)
 
 
+def get_database()->AsyncIOMotorDatabase:
+    """The application database. The client is created on first use if connect() hasn't run yet."""
+    global client
+    if client is None:
+        client=create_client()
+    return client[setting.database_name]
+
+
+async def connect():
+    """Create the client and open mongo_min_pool_size connections before the worker takes traffic"""
+    database=get_database()
+    if setting.mongo_prewarm and setting.mongo_min_pool_size:
+        await asyncio.gather(*(database.command("ping") for _ in range(setting.mongo_min_pool_size)))
+        logger.info("Pre-warmed MongoDB connection pool with %s connections", setting.mongo_min_pool_size)
+
+
+async def supports_transactions()->bool:
+    """Whether the deployment runs multi-document transactions, which a standalone server doesn't"""
+    if setting.mongo_transactions is not None:
+        return setting.mongo_transactions
+    database=get_database()
+    if id(client) not in _transactions:
+        try:
+            hello=await database.command("hello")
+            _transactions[id(client)]="setName" in hello or hello.get("msg")=="isdbgrid"
+        except PyMongoError as error:
+            logger.warning("Could not tell whether MongoDB supports transactions: %s",error)
+            return False
+    return _transactions[id(client)]
+
+
+def disconnect():
+    global client
+    if client is not None:
+        _transactions.pop(id(client),None)
+        client.close()
+        client=None
+
+
+class LazyCollection:
+    """Stands in for a Motor collection that is resolved on first use, so importing the app needs no database"""
+
+    def __init__(self,name:str,**options:Any):
+        self.name=name
+        self.options=options
+        self._client=None
+        self._collection=None
+
+    def resolve(self):
+        if self._client is not client or self._collection is None:
+            collection=get_database()[self.name]
+            self._collection=collection.with_options(**self.options) if self.options else collection
+            self._client=client
+        return self._collection
+
+    def __getattr__(self,attribute:str):
+        return getattr(self.resolve(),attribute)
+
+
+users_collection = LazyCollection("users")
+books_collection =LazyCollection("books")
+book_logs_collection=LazyCollection("book_logs")
+meta_collection=LazyCollection("meta")
+jobs_collection=LazyCollection("jobs")
+stats_collection=LazyCollection("stats")
+loans_collection=LazyCollection("loans")
+holds_collection=LazyCollection("holds")
+
+READ_PRIMARY="primary"
+READ_SECONDARY="secondary"
+# endpoints whose reads tolerate replication lag, read_routing can move any of them back to the primary
+SECONDARY_READ_ENDPOINTS={
+    "stream_all_books",
+    "search_books",
+    "get_members_list",
+    "get_history",
+    "get_member_by_id",
+    "get_stats",
+    "get_overdue_loans",
+}
+# reads that read_routing can't move off the primary: pages tagged with the primary's catalogue version, and
+# responses stored in the response cache, which a lagging secondary would fill after the invalidation it missed
+CACHE_FILL_READS="response_cache_fill"
+PRIMARY_READ_ENDPOINTS={
+    "get_all_books",
+    "get_book_by_id",
+    CACHE_FILL_READS,
+}
+_read_collections={}
+
+
+def read_collection(name:str,endpoint:str)->LazyCollection:
+    """Collection handle for the reads of endpoint. Reads go to a secondary within
+    read_replica_max_staleness_seconds when the endpoint is routed there, and to the primary otherwise."""
+    default=READ_SECONDARY if endpoint in SECONDARY_READ_ENDPOINTS else READ_PRIMARY
+    route=READ_SECONDARY if setting.read_routing.get(endpoint,default)==READ_SECONDARY else READ_PRIMARY
+    if endpoint in PRIMARY_READ_ENDPOINTS:
+        route=READ_PRIMARY
+    if (name,route) not in _read_collections:
+        if route==READ_SECONDARY:
+            read_preference=SecondaryPreferred(max_staleness=setting.read_replica_max_staleness_seconds)
+        else:
+            read_preference=Primary()
+        _read_collections[(name,route)]=LazyCollection(name,read_preference=read_preference)
+    return _read_collections[(name,route)]
@@ -0,0 +1,106 @@
+import logging
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import PyMongoError
+
+from api.database.connection import get_database
+
+logger = logging.getLogger(__name__)
+
+OPTION_KEYS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds", "weights")
+
+REQUIRED_INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_active_unique", unique=True,
+                   partialFilterExpression={"is_deleted": False}),
+        IndexModel([("user_type", ASCENDING)], name="user_type"),
+        IndexModel([("token_version_ts", ASCENDING)], name="token_version_ts", sparse=True),
+    ],
+    "books": [
+        IndexModel([("is_deleted", ASCENDING), ("_id", ASCENDING)], name="is_deleted_id"),
+        IndexModel([("is_deleted", ASCENDING), ("borrow_count", DESCENDING)], name="is_deleted_borrow_count"),
+        # facet filters of GET /books/search, in the id order of its results
+        IndexModel([("is_deleted", ASCENDING), ("genre", ASCENDING), ("_id", ASCENDING)], name="is_deleted_genre_id"),
+        IndexModel([("is_deleted", ASCENDING), ("author", ASCENDING), ("_id", ASCENDING)],
+                   name="is_deleted_author_id"),
+        IndexModel([("is_deleted", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)],
+                   name="is_deleted_status_id"),
+        IndexModel([("name", TEXT), ("author", TEXT), ("description", TEXT), ("genre", TEXT)],
+                   name="catalogue_text", weights={"name": 10, "author": 5, "genre": 3, "description": 1}),
+    ],
+    "book_logs": [
+        IndexModel([("member_id", ASCENDING), ("ts", ASCENDING), ("_id", ASCENDING)], name="member_id_ts"),
+    ],
+    "loans": [
+        IndexModel([("book_id", ASCENDING), ("member_id", ASCENDING)], name="book_member_active_unique", unique=True,
+                   partialFilterExpression={"status": "ACTIVE"}),
+        IndexModel([("status", ASCENDING), ("due_ts", ASCENDING), ("_id", ASCENDING)], name="status_due_ts"),
+        IndexModel([("member_id", ASCENDING), ("status", ASCENDING)], name="member_id_status"),
+    ],
+    "holds": [
+        IndexModel([("book_id", ASCENDING), ("member_id", ASCENDING)], name="book_member_waiting_unique", unique=True,
+                   partialFilterExpression={"status": "WAITING"}),
+        IndexModel([("book_id", ASCENDING), ("status", ASCENDING), ("created_ts", ASCENDING), ("_id", ASCENDING)],
+                   name="book_id_status_created_ts"),
+        IndexModel([("member_id", ASCENDING), ("status", ASCENDING)], name="member_id_status"),
+    ],
+    "stats": [
+        IndexModel([("dimension", ASCENDING), ("value", ASCENDING)], name="dimension_value_unique", unique=True),
+        IndexModel([("dimension", ASCENDING), ("count", DESCENDING)], name="dimension_count"),
+    ],
+    "jobs": [
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("enqueued_at", ASCENDING)], name="enqueued_at"),
+    ],
+}
+
+
+def _index_spec(index: dict) -> dict:
+    key = list(index["key"].items()) if isinstance(index["key"], dict) else list(index["key"])
+    if any(direction == TEXT for _, direction in key):
+        # the server reports text indexes as _fts/_ftsx, the indexed fields only show up in weights
+        key = [(field, direction) for field, direction in key if direction != TEXT and field not in ("_fts", "_ftsx")]
+        key += [("_fts", TEXT), ("_ftsx", 1)]
+    spec = {"key": key}
+    for option in OPTION_KEYS:
+        if option in index:
+            spec[option] = index[option]
+    return spec
+
+
+async def ensure_indexes() -> dict:
+    """Create the declared indexes that are missing and report the ones that drifted from their declaration.
+    Existing indexes are never dropped, drift is only logged so it can be fixed by hand."""
+    report = {}
+    db = get_database()
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        collection_report = {"created": [], "drift": [], "extra": [], "failed": []}
+        try:
+            existing = await collection.index_information()
+        except PyMongoError as error:
+            logger.error("Could not read indexes of %s: %s", collection_name, error)
+            collection_report["failed"] = [index.document["name"] for index in indexes]
+            report[collection_name] = collection_report
+            continue
+        declared_names = set()
+        for index in indexes:
+            name = index.document["name"]
+            declared_names.add(name)
+            if name in existing:
+                if _index_spec(existing[name]) != _index_spec(index.document):
+                    collection_report["drift"].append(name)
+                    logger.warning("Index %s.%s differs from its declaration", collection_name, name)
+                continue
+            try:
+                await collection.create_indexes([index])
+                collection_report["created"].append(name)
+                logger.info("Created index %s.%s", collection_name, name)
+            except PyMongoError as error:
+                collection_report["failed"].append(name)
+                logger.error("Could not create index %s.%s: %s", collection_name, name, error)
+        collection_report["extra"] = [name for name in existing if name != "_id_" and name not in declared_names]
+        for name in collection_report["extra"]:
+            logger.warning("Index %s.%s is not declared in REQUIRED_INDEXES", collection_name, name)
+        report[collection_name] = collection_report
+    return report
@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from api.database.connection import jobs_collection, Settings
+from api.utils.metrics import registry
+from api.utils.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+job_lag = registry.histogram(
+    "job_queue_lag_seconds", "Time jobs waited between being enqueued and starting", ("job",))
+job_duration = registry.histogram(
+    "job_duration_seconds", "Time spent running jobs", ("job",))
+job_results = registry.counter(
+    "jobs_total", "Finished job attempts", ("job", "result"))
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class MemoryJobStore:
+    """Jobs of this process ordered by run_at. They are lost if the process dies before running them."""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._heap = []
+        self._sequence = itertools.count()
+
+    async def put(self, job: dict):
+        if len(self._heap) >= self.max_pending:
+            raise JobQueueFull(f"{len(self._heap)} jobs are pending")
+        heapq.heappush(self._heap, (job["run_at"], next(self._sequence), job))
+
+    async def claim(self, now: int, draining: bool) -> Optional[dict]:
+        # while draining, jobs scheduled for a retry run right away
+        if self._heap and (draining or self._heap[0][0] <= now):
+            job = heapq.heappop(self._heap)[2]
+            job["attempts"] += 1
+            return job
+        return None
+
+    async def complete(self, job: dict):
+        pass
+
+    async def retry(self, job: dict, run_at: int, error: str):
+        job["run_at"] = run_at
+        job["error"] = error
+        heapq.heappush(self._heap, (run_at, next(self._sequence), job))
+
+    async def fail(self, job: dict, error: str):
+        pass
+
+    def stats(self) -> dict:
+        oldest = min((job["enqueued_at"] for _, _, job in self._heap), default=None)
+        return {
+            "pending": len(self._heap),
+            "oldest_pending_seconds": (get_timestamp() - oldest) / 1000 if oldest else 0
+        }
+
+
+class MongoJobStore:
+    """Jobs in the jobs collection, shared by every worker and kept across restarts.
+    A claimed job is leased for lease_seconds, a worker that dies while running it hands it to another one
+    once the lease ends, so a job may run more than once."""
+
+    def __init__(self, collection, lease_seconds: float):
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self._stats = {"pending": 0, "oldest_pending_seconds": 0}
+
+    async def put(self, job: dict):
+        await self.collection.insert_one({**job, "status": JOB_PENDING})
+
+    async def claim(self, now: int, draining: bool) -> Optional[dict]:
+        if draining:
+            # pending jobs stay in the collection for the next start
+            return None
+        # a running job's run_at is the end of its lease
+        return await self.collection.find_one_and_update(
+            {"status": {"$in": [JOB_PENDING, JOB_RUNNING]}, "run_at": {"$lte": now}},
+            {"$set": {"status": JOB_RUNNING, "run_at": now + int(self.lease_seconds * 1000)},
+             "$inc": {"attempts": 1}},
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER)
+
+    async def complete(self, job: dict):
+        await self.collection.delete_one({"_id": job["_id"]})
+
+    async def retry(self, job: dict, run_at: int, error: str):
+        await self.collection.update_one({"_id": job["_id"]},
+                                         {"$set": {"status": JOB_PENDING, "run_at": run_at, "error": error}})
+
+    async def fail(self, job: dict, error: str):
+        await self.collection.update_one({"_id": job["_id"]},
+                                         {"$set": {"status": JOB_FAILED, "error": error,
+                                                   "failed_ts": get_timestamp()}})
+
+    async def refresh_stats(self):
+        query = {"status": {"$in": [JOB_PENDING, JOB_RUNNING]}}
+        oldest = await self.collection.find_one(query, {"enqueued_at": 1}, sort=[("enqueued_at", 1)])
+        self._stats = {
+            "pending": await self.collection.count_documents(query),
+            "oldest_pending_seconds": (get_timestamp() - oldest["enqueued_at"]) / 1000 if oldest else 0
+        }
+
+    def stats(self) -> dict:
+        return self._stats
+
+
+class JobQueue:
+    """Runs side effects after the request that caused them has been answered, on concurrency worker tasks.
+    A failing job is retried after retry_delay seconds, doubled per attempt, up to max_attempts attempts.
+    Jobs of durable tasks go to the durable store when there is one, the others stay in memory."""
+
+    def __init__(self, concurrency: int, max_attempts: int, retry_delay: float, poll_interval: float,
+                 memory_store: MemoryJobStore, durable_store: Optional[MongoJobStore] = None):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.memory_store = memory_store
+        self.durable_store = durable_store
+        self.running = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self._handlers: Dict[str, Tuple[Callable, bool]] = {}
+        self._wakeup = asyncio.Event()
+        self._workers = []
+        self._monitor: Optional[asyncio.Task] = None
+        self._draining = False
+
+    def task(self, name: str, durable: bool = True):
+        """Registers the decorated coroutine function as the handler of name. Jobs of a task that isn't durable
+        never leave the process, use it when the payload must not be stored, e.g. a plain password."""
+        def register(func: Callable):
+            self._handlers[name] = (func, durable)
+            return func
+        return register
+
+    def _stores(self) -> list:
+        return [self.durable_store, self.memory_store] if self.durable_store else [self.memory_store]
+
+    async def enqueue(self, name: str, **payload):
+        _, durable = self._handlers[name]
+        now = get_timestamp()
+        job = {"_id": ObjectId(), "name": name, "payload": payload, "attempts": 0, "enqueued_at": now, "run_at": now}
+        store = self.durable_store if durable and self.durable_store else self.memory_store
+        await store.put(job)
+        self._wakeup.set()
+
+    async def _claim(self):
+        for store in self._stores():
+            try:
+                job = await store.claim(get_timestamp(), self._draining)
+            except PyMongoError as error:
+                logger.warning("Could not claim a job: %s", error)
+                continue
+            if job is not None:
+                return store, job
+        return None
+
+    async def _work(self):
+        while True:
+            claimed = await self._claim()
+            if claimed is None:
+                if self._draining:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            await self._run(*claimed)
+
+    async def _run(self, store, job: dict):
+        name = job["name"]
+        if job["attempts"] == 1:
+            job_lag.observe(max(get_timestamp() - job["enqueued_at"], 0) / 1000, job=name)
+        handler = self._handlers.get(name)
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job {name}")
+            await handler[0](**job["payload"])
+        except Exception as error:
+            await self._failed(store, job, repr(error))
+        else:
+            self.completed += 1
+            job_results.inc(job=name, result="completed")
+            try:
+                await store.complete(job)
+            except PyMongoError as error:
+                logger.warning("Could not mark job %s %s as completed: %s", name, job["_id"], error)
+        finally:
+            self.running -= 1
+            job_duration.observe(time.perf_counter() - started, job=name)
+
+    async def _failed(self, store, job: dict, error: str):
+        name = job["name"]
+        try:
+            if job["attempts"] < self.max_attempts and name in self._handlers:
+                self.retried += 1
+                job_results.inc(job=name, result="retried")
+                delay = self.retry_delay * 2 ** (job["attempts"] - 1)
+                logger.warning("Job %s %s failed on attempt %s, retrying in %.1f s: %s",
+                               name, job["_id"], job["attempts"], delay, error)
+                await store.retry(job, get_timestamp() + int(delay * 1000), error)
+            else:
+                self.failed += 1
+                job_results.inc(job=name, result="failed")
+                logger.error("Job %s %s failed after %s attempts: %s", name, job["_id"], job["attempts"], error)
+                await store.fail(job, error)
+        except PyMongoError as store_error:
+            logger.warning("Could not record the failure of job %s %s: %s", name, job["_id"], store_error)
+
+    async def _refresh_stats(self):
+        while True:
+            try:
+                await self.durable_store.refresh_stats()
+            except PyMongoError as error:
+                logger.warning("Could not refresh job queue stats: %s", error)
+            await asyncio.sleep(max(self.poll_interval, 5))
+
+    def start(self):
+        if not self._workers:
+            self._draining = False
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+            if self.durable_store:
+                self._monitor = asyncio.create_task(self._refresh_stats())
+
+    async def stop(self, drain_timeout: float):
+        """Lets the workers finish the jobs held in memory, or cancels them after drain_timeout seconds"""
+        if not self._workers:
+            return
+        self._draining = True
+        self._wakeup.set()
+        done, pending = await asyncio.wait(self._workers, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+        if self._monitor is not None:
+            self._monitor.cancel()
+            pending.add(self._monitor)
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending - {self._monitor}:
+            logger.error("Job queue did not drain within %s s, %s jobs in memory were dropped",
+                         drain_timeout, self.memory_store.stats()["pending"])
+        self._workers = []
+        self._monitor = None
+
+    def stats(self) -> dict:
+        stats = {
+            "running": self.running,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+        for store in self._stores():
+            prefix = "durable" if store is self.durable_store else "memory"
+            for field, value in store.stats().items():
+                stats[f"{prefix}_{field}"] = value
+        return stats
+
+
+job_queue = JobQueue(concurrency=setting.job_queue_concurrency,
+                     max_attempts=setting.job_queue_max_attempts,
+                     retry_delay=setting.job_queue_retry_delay,
+                     poll_interval=setting.job_queue_poll_interval,
+                     memory_store=MemoryJobStore(setting.job_queue_max_pending),
+                     durable_store=MongoJobStore(jobs_collection, setting.job_queue_lease_seconds)
+                     if setting.job_queue_backend == "mongo" else None)
+registry.gauges("job_queue", "Background job queue", job_queue.stats)
@@ -0,0 +1,286 @@
+import asyncio
+import functools
+import inspect
+import logging
+from typing import Optional, Any, Awaitable, Callable
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from api.database.book_log_writer import book_log_writer
+from api.database.catalogue_stats import record_stats, copies_increments, status_increments
+from api.database import connection
+from api.database.connection import books_collection, loans_collection, holds_collection, meta_collection, Settings, \
+    supports_transactions
+from api.database.overdue_sweeper import due_ts_of
+from api.model.book import BookStatus
+from api.model.book_log import BookLogAction
+from api.model.hold import HoldStatus
+from api.model.loan import LoanStatus
+from api.utils.event_hub import book_events
+from api.utils.http_cache import CatalogueVersion
+from api.utils.metrics import registry
+from api.utils.response_cache import response_cache
+from api.utils.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+# second stage of the updates that change available_copies, a title is borrowed once no copy is left
+SET_STATUS_FROM_COPIES = {"$set": {"status": {"$cond": [{"$gt": ["$available_copies", 0]},
+                                                        BookStatus.available.value, BookStatus.borrowed.value]}}}
+catalogue_version = CatalogueVersion(meta_collection, setting.catalogue_version_refresh_seconds)
+BOOK_PROJECTION = {"_id": 1, "name": 1, "available_copies": 1, "status": 1, "borrowed_by_name": 1, "is_deleted": 1}
+
+
+def book_changed(book: dict):
+    """Pushes the availability of book to the clients of GET /books/events"""
+    book_events.publish("book", {
+        "book_id": str(book["_id"]),
+        "status": book.get("status") or BookStatus.available.value,
+        "available_copies": book.get("available_copies", 1),
+        "borrowed_by": book.get("borrowed_by_name") or "",
+        "deleted": book.get("is_deleted", False)
+    })
+
+
+async def in_transaction(operation: Callable[..., Awaitable]) -> Any:
+    """Runs operation(session, effects) in one transaction when the deployment supports them, so its writes are
+    applied together or not at all, and as separate writes with no session otherwise. A transaction that meets
+    a write conflict is run again, so the operation queues what must happen once, like stats and the book log,
+    on effects, which are called after the writes are committed."""
+    effects = []
+
+    async def attempt(session):
+        effects.clear()
+        return await operation(session, effects)
+
+    if await supports_transactions():
+        async with await connection.client.start_session() as session:
+            result = await session.with_transaction(attempt)
+    else:
+        result = await attempt(None)
+    for effect in effects:
+        outcome = effect()
+        if inspect.isawaitable(outcome):
+            await outcome
+    return result
+
+
+async def hand_off_copy(book_id: ObjectId, now: int, session, effects: list) -> Optional[dict]:
+    """Lends a copy the caller holds, e.g. a returned one, to the first member waiting for the book. The copy is
+    never made available in between, so nobody can borrow it ahead of the queue. Run it through in_transaction:
+    on a replica set the loan, the hold and the book change in one transaction. A standalone server has no
+    transactions, so there the writes follow each other, ordered so that running the hand-off again after a
+    failure completes it: the loan is opened before the hold is claimed, and a waiting hold whose member has
+    a loan of the book already is closed rather than served twice. Returns None when nobody is waiting."""
+    skipped = []
+    while True:
+        hold = await holds_collection.find_one({"book_id": book_id, "status": HoldStatus.waiting,
+                                                "_id": {"$nin": skipped}},
+                                               sort=[("created_ts", 1), ("_id", 1)], session=session)
+        if not hold:
+            return None
+        skipped.append(hold["_id"])
+        if await loans_collection.find_one({"book_id": book_id, "member_id": hold["member_id"],
+                                            "status": LoanStatus.active}, {"_id": 1}, session=session):
+            # left waiting by a hand-off that stopped after opening the loan, or the member borrowed a copy
+            await holds_collection.update_one({"_id": hold["_id"], "status": HoldStatus.waiting},
+                                              {"$set": {"status": HoldStatus.fulfilled, "fulfilled_ts": now}},
+                                              session=session)
+            continue
+        loan = {
+            "book_id": book_id,
+            "book_name": hold.get("book_name"),
+            "member_id": hold["member_id"],
+            "member_name": hold.get("member_name"),
+            "borrowed_ts": now,
+            "due_ts": due_ts_of(now),
+            "returned_ts": 0,
+            "status": LoanStatus.active
+        }
+        try:
+            await loans_collection.insert_one(loan, session=session)
+        except DuplicateKeyError:
+            # the member borrowed a copy meanwhile, in a transaction the conflict makes it run again
+            continue
+        claimed = await holds_collection.update_one({"_id": hold["_id"], "status": HoldStatus.waiting},
+                                                    {"$set": {"status": HoldStatus.fulfilled, "fulfilled_ts": now}},
+                                                    session=session)
+        if not claimed.modified_count and await holds_collection.find_one(
+                {"_id": hold["_id"], "status": HoldStatus.cancelled}, {"_id": 1}, session=session):
+            # cancelled meanwhile, the copy goes to the next member
+            await loans_collection.delete_one({"_id": loan["_id"]}, session=session)
+            continue
+        book = await books_collection.find_one_and_update(
+            {"_id": book_id},
+            {"$set": {"borrowed_by_id": hold["member_id"], "borrowed_by_name": hold.get("member_name"),
+                      "borrowed_ts": now, "returned_ts": now, "updated_ts": now},
+             "$inc": {"borrow_count": 1}},
+            projection=BOOK_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+            session=session)
+        effects.append(functools.partial(book_log_writer.append, {
+            "member_id": hold["member_id"],
+            "member_name": hold.get("member_name"),
+            "book_id": book_id,
+            "book_name": hold.get("book_name"),
+            "action": BookLogAction.borrow,
+            "ts": now
+        }))
+        return book or {"_id": book_id, "name": hold.get("book_name")}
+
+
+async def _serve_hold(book_id: ObjectId, now: int, session, effects: list) -> Optional[dict]:
+    """Takes an available copy of the book and hands it to the first member waiting"""
+    book = await books_collection.find_one_and_update(
+        {"_id": book_id, "is_deleted": False, "available_copies": {"$gt": 0}},
+        [{"$set": {"available_copies": {"$subtract": ["$available_copies", 1]}, "updated_ts": now}},
+         SET_STATUS_FROM_COPIES],
+        projection={"available_copies": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session)
+    if not book:
+        return None
+    handed = await hand_off_copy(book_id, now, session, effects)
+    if not handed:
+        # the holds were cancelled or served meanwhile
+        await books_collection.update_one(
+            {"_id": book_id},
+            [{"$set": {"available_copies": {"$min": ["$total_copies", {"$add": ["$available_copies", 1]}]}}},
+             SET_STATUS_FROM_COPIES],
+            session=session)
+        return None
+    increments = copies_increments(1)
+    if book["available_copies"] == 0:
+        increments += status_increments(BookStatus.available.value, BookStatus.borrowed.value)
+    effects.append(functools.partial(record_stats, increments))
+    return handed
+
+
+async def serve_holds(book_id: ObjectId, now: int) -> Optional[dict]:
+    """Hands the available copies of the book to the members waiting for it, for when copies and holds meet
+    some other way than a return: copies added to the title, or a hold placed just as a copy came back.
+    Each copy is taken and handed off in one transaction where the deployment has them.
+    Returns the book after the last hand-off, None when no hold was served."""
+    served = None
+    while await holds_collection.find_one({"book_id": book_id, "status": HoldStatus.waiting}, {"_id": 1}):
+        handed = await in_transaction(functools.partial(_serve_hold, book_id, now))
+        if not handed:
+            break
+        served = handed
+    return served
+
+
+class CopyReconciler:
+    """Borrowing and returning change a loan and the book's available_copies in two writes, so a worker that
+    fails in between leaves a title with a copy too many or too few. Every interval seconds (never when 0) this
+    compares available_copies with total_copies minus the active loans of each title. A title is only repaired
+    when it showed the same difference, untouched, on the previous run too, which a borrow or return that is
+    still running can't, and the repair is conditional on the book being unchanged since it was read.
+    Holds left waiting by an interrupted hand-off, or next to an available copy, are settled too."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.repaired = 0
+        self.last_run_ts = 0
+        self._suspects = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def reconcile(self) -> int:
+        active = {}
+        async for group in loans_collection.aggregate([
+            {"$match": {"status": LoanStatus.active}},
+            {"$group": {"_id": "$book_id", "count": {"$sum": 1}}}
+        ]):
+            active[group["_id"]] = group["count"]
+        suspects, repaired = {}, []
+        async for book in books_collection.find(
+                {"is_deleted": False, "total_copies": {"$exists": True}},
+                {"total_copies": 1, "available_copies": 1, "updated_ts": 1}):
+            loans = active.get(book["_id"], 0)
+            expected = max(book["total_copies"] - loans, 0)
+            if book["available_copies"] == expected:
+                continue
+            observed = (book["available_copies"], loans, book.get("updated_ts"))
+            suspects[book["_id"]] = observed
+            if self._suspects.get(book["_id"]) != observed:
+                continue
+            now = get_timestamp()
+            before = await books_collection.find_one_and_update(
+                {"_id": book["_id"], "available_copies": observed[0], "updated_ts": observed[2]},
+                [{"$set": {"available_copies": expected, "updated_ts": now}}, SET_STATUS_FROM_COPIES],
+                projection={"status": 1})
+            if before is None:
+                continue
+            logger.warning("Repaired the available copies of book %s from %s to %s",
+                           book["_id"], observed[0], expected)
+            increments = copies_increments(observed[0] - expected)
+            if (observed[0] > 0) != (expected > 0):
+                increments += status_increments(before["status"],
+                                                BookStatus.available.value if expected
+                                                else BookStatus.borrowed.value)
+            await record_stats(increments)
+            repaired.append(book["_id"])
+        self._suspects = suspects
+        changed = set(repaired) | await self._serve_waiting_holds()
+        for book in await books_collection.find({"_id": {"$in": list(changed)}}, BOOK_PROJECTION) \
+                .to_list(None):
+            book_changed(book)
+        if changed:
+            await catalogue_version.bump()
+            await response_cache.invalidate("books")
+        self.repaired += len(repaired)
+        self.last_run_ts = get_timestamp()
+        return len(repaired)
+
+    async def _serve_waiting_holds(self) -> set:
+        """Closes the waiting holds of members who got a loan of the book, which a hand-off interrupted after
+        opening the loan leaves behind, and serves the holds of titles that have a copy available.
+        Returns the ids of the books that were lent."""
+        waiting = set()
+        async for hold in holds_collection.find({"status": HoldStatus.waiting}, {"book_id": 1, "member_id": 1}):
+            if await loans_collection.find_one({"book_id": hold["book_id"], "member_id": hold["member_id"],
+                                                "status": LoanStatus.active}, {"_id": 1}):
+                await holds_collection.update_one({"_id": hold["_id"], "status": HoldStatus.waiting},
+                                                  {"$set": {"status": HoldStatus.fulfilled,
+                                                            "fulfilled_ts": get_timestamp()}})
+            else:
+                waiting.add(hold["book_id"])
+        served = set()
+        async for book in books_collection.find({"_id": {"$in": list(waiting)}, "is_deleted": False,
+                                                 "available_copies": {"$gt": 0}}, {"_id": 1}):
+            if await serve_holds(book["_id"], get_timestamp()):
+                logger.warning("Served the holds of book %s, which had a copy available", book["_id"])
+                served.add(book["_id"])
+        return served
+
+    async def _run(self):
+        while self.interval:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except PyMongoError as error:
+                logger.error("Could not reconcile available copies: %s", error)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "repaired": self.repaired,
+            "suspects": len(self._suspects),
+            "last_run_ts": self.last_run_ts
+        }
+
+
+copy_reconciler = CopyReconciler(setting.copies_reconcile_interval)
+registry.gauges("copy_reconciler", "Available copies reconciler", copy_reconciler.stats)
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from pymongo.errors import BulkWriteError
+
+from api.database.connection import books_collection, loans_collection, meta_collection, connect, disconnect, \
+    Settings
+from api.database.overdue_sweeper import DAY_MS, due_ts_of
+from api.model.book import BookStatus
+from api.model.loan import LoanStatus
+from api.utils.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+# names of the migrations that completed, so later starts skip their scans
+MIGRATIONS_ID = "migrations"
+
+
+async def _completed(name: str) -> bool:
+    return await meta_collection.find_one({"_id": MIGRATIONS_ID, name: {"$exists": True}}, {"_id": 1}) is not None
+
+
+async def _mark_completed(name: str):
+    await meta_collection.update_one({"_id": MIGRATIONS_ID}, {"$set": {name: get_timestamp()}}, upsert=True)
+
+
+async def migrate_book_copies(force: bool = False) -> dict:
+    """Turns books written before copies were tracked into titles of one copy. A borrowed one gets an active loan
+    for its borrower, so it can be returned. Safe to run again, migrated books are skipped. Once it completed,
+    it only runs again when forced, e.g. after old books were restored."""
+    if not force and await _completed("book_copies"):
+        return {}
+    legacy = {"total_copies": {"$exists": False}}
+    loans = []
+    async for book in books_collection.find({**legacy, "status": BookStatus.borrowed,
+                                             "borrowed_by_id": {"$ne": None}}):
+        loans.append({
+            "book_id": book["_id"],
+            "book_name": book.get("name"),
+            "member_id": book["borrowed_by_id"],
+            "member_name": book.get("borrowed_by_name"),
+            "borrowed_ts": book.get("borrowed_ts", 0),
+            "due_ts": due_ts_of(book.get("borrowed_ts", 0)),
+            "returned_ts": 0,
+            "status": LoanStatus.active
+        })
+    created = 0
+    if loans:
+        try:
+            created = len((await loans_collection.insert_many(loans, ordered=False)).inserted_ids)
+        except BulkWriteError as error:
+            # loans created by an interrupted earlier run
+            if any(x.get("code") != 11000 for x in error.details["writeErrors"]):
+                raise
+            created = error.details.get("nInserted", 0)
+    borrowed = await books_collection.update_many({**legacy, "status": BookStatus.borrowed},
+                                                  {"$set": {"total_copies": 1, "available_copies": 0}})
+    available = await books_collection.update_many(legacy, {"$set": {"total_copies": 1, "available_copies": 1}})
+    report = {
+        "borrowed": borrowed.modified_count,
+        "available": available.modified_count,
+        "loans_created": created
+    }
+    if borrowed.modified_count or available.modified_count:
+        logger.info("Migrated books to copies: %s", report)
+    await _mark_completed("book_copies")
+    return report
+
+
+async def migrate_loan_due_dates(force: bool = False) -> int:
+    """Gives loans opened before due dates existed the due date of a loan borrowed at their borrowed_ts.
+    Skipped once it completed, unless forced."""
+    if not force and await _completed("loan_due_dates"):
+        return 0
+    result = await loans_collection.update_many(
+        {"due_ts": {"$exists": False}},
+        [{"$set": {"due_ts": {"$add": [{"$ifNull": ["$borrowed_ts", 0]}, setting.loan_period_days * DAY_MS]}}}])
+    if result.modified_count:
+        logger.info("Set the due date of %s loans", result.modified_count)
+    await _mark_completed("loan_due_dates")
+    return result.modified_count
+
+
+async def main():
+    await connect()
+    try:
+        print(await migrate_book_copies(force=True))
+        print(await migrate_loan_due_dates(force=True))
+    finally:
+        disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import math
+from typing import Optional
+
+from pymongo.errors import PyMongoError
+
+from api.database.book_log_writer import book_log_writer
+from api.database.catalogue_stats import record_stats, overdue_increments
+from api.database.connection import loans_collection, meta_collection, Settings
+from api.model.book_log import BookLogAction
+from api.model.loan import LoanStatus
+from api.utils.metrics import registry
+from api.utils.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+DAY_MS = 24 * 60 * 60 * 1000
+SWEEP_STATE_ID = "overdue_sweep"
+
+
+def due_ts_of(borrowed_ts: int) -> int:
+    return borrowed_ts + setting.loan_period_days * DAY_MS
+
+
+def accrued_fine(due_ts: Optional[int], now: int) -> float:
+    """Fine of a loan due at due_ts, every started day past the due date costs overdue_fine_per_day"""
+    if not due_ts or now <= due_ts:
+        return 0
+    return round(math.ceil((now - due_ts) / DAY_MS) * setting.overdue_fine_per_day, 2)
+
+
+def fine_expression(now: int) -> dict:
+    """accrued_fine as an aggregation expression of the loan's due_ts, for updates that close the loan. It counts in
+    cents, so the stored fine is rounded like accrued_fine's."""
+    days_late = {"$ceil": {"$divide": [{"$max": [0, {"$subtract": [now, {"$ifNull": ["$due_ts", now]}]}]}, DAY_MS]}}
+    return {"$divide": [{"$multiply": [days_late, round(setting.overdue_fine_per_day * 100)]}, 100]}
+
+
+class OverdueSweeper:
+    """Flags active loans that passed their due date with overdue_ts and adds an OVERDUE event to the member's
+    history, every interval seconds (never when 0). A sweep walks the status/due_ts index from where the last
+    one stopped, batch_size loans at a time, so it only reads loans that became overdue since."""
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flagged = 0
+        self.last_sweep_ts = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def sweep(self) -> int:
+        now = get_timestamp()
+        state = await meta_collection.find_one({"_id": SWEEP_STATE_ID}) or {}
+        last_due_ts, last_id = state.get("due_ts", 0), state.get("loan_id")
+        flagged = 0
+        while True:
+            after = [{"due_ts": {"$gt": last_due_ts}}]
+            if last_id is not None:
+                after.append({"due_ts": last_due_ts, "_id": {"$gt": last_id}})
+            loans = await loans_collection.find(
+                {"status": LoanStatus.active, "due_ts": {"$lt": now}, "$or": after},
+                {"book_id": 1, "book_name": 1, "member_id": 1, "member_name": 1, "due_ts": 1}) \
+                .sort([("due_ts", 1), ("_id", 1)]).to_list(self.batch_size)
+            batch_flagged = 0
+            for loan in loans:
+                # another worker sweeping the same range flags each loan once
+                result = await loans_collection.update_one(
+                    {"_id": loan["_id"], "status": LoanStatus.active, "overdue_ts": {"$exists": False}},
+                    {"$set": {"overdue_ts": now}})
+                if result.modified_count:
+                    batch_flagged += 1
+                    book_log_writer.append({
+                        "member_id": loan["member_id"],
+                        "member_name": loan.get("member_name"),
+                        "book_id": loan["book_id"],
+                        "book_name": loan.get("book_name"),
+                        "action": BookLogAction.overdue,
+                        "ts": now
+                    })
+            if batch_flagged:
+                flagged += batch_flagged
+                await record_stats(overdue_increments(batch_flagged))
+            if loans:
+                last_due_ts, last_id = loans[-1]["due_ts"], loans[-1]["_id"]
+                await meta_collection.update_one({"_id": SWEEP_STATE_ID},
+                                                 {"$set": {"due_ts": last_due_ts, "loan_id": last_id}},
+                                                 upsert=True)
+            if len(loans) < self.batch_size:
+                break
+            # let requests run between batches
+            await asyncio.sleep(0)
+        self.flagged += flagged
+        self.last_sweep_ts = now
+        if flagged:
+            logger.info("Flagged %s overdue loans", flagged)
+        return flagged
+
+    async def _run(self):
+        while self.interval:
+            try:
+                await self.sweep()
+            except PyMongoError as error:
+                logger.error("Could not sweep overdue loans: %s", error)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "flagged": self.flagged,
+            "last_sweep_ts": self.last_sweep_ts
+        }
+
+
+overdue_sweeper = OverdueSweeper(setting.overdue_sweep_interval, setting.overdue_sweep_batch_size)
+registry.gauges("overdue_sweeper", "Overdue loan sweeper", overdue_sweeper.stats)
@@ -1,15 +1,73 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 import uvicorn
 
 from fastapi.middleware.cors import CORSMiddleware
-from api.router import auth, books, members
 
-app=FastAPI()
+from api.auth.hash_password import shutdown_hash_pools, configure_password_hashing
+from api.auth.token_revocation import token_revocations
+from api.database.book_log_writer import book_log_writer
+from api.database.catalogue_stats import stats_rebuilder
+from api.database.connection import Settings, connect, disconnect
+from api.database.indexes import ensure_indexes
+from api.database.job_queue import job_queue
+from api.database.lending import copy_reconciler
+from api.database.migrations import migrate_book_copies, migrate_loan_due_dates
+from api.database.overdue_sweeper import overdue_sweeper
+from api.router import auth, books, loans, members, metrics, stats
+from api.utils.event_hub import book_events
+from api.utils.instrumentation import MetricsMiddleware
+from api.utils.rate_limit import RateLimitMiddleware, create_backend, parse_rules
+from api.utils.response_cache import start_response_cache, stop_response_cache
+
+setting=Settings()
+rate_limit_backend=create_backend(setting.rate_limit_backend,setting.rate_limit_url,setting.rate_limit_max_keys)
+
+
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    await asyncio.to_thread(configure_password_hashing)
+    await connect()
+    if setting.ensure_indexes:
+        await ensure_indexes()
+    if setting.migrate_on_startup:
+        await migrate_book_copies()
+        await migrate_loan_due_dates()
+    book_log_writer.start()
+    job_queue.start()
+    stats_rebuilder.start()
+    overdue_sweeper.start()
+    copy_reconciler.start()
+    token_revocations.start()
+    start_response_cache()
+    yield
+    book_events.close()
+    await stop_response_cache()
+    await token_revocations.stop()
+    await copy_reconciler.stop()
+    await overdue_sweeper.stop()
+    await stats_rebuilder.stop()
+    await book_log_writer.stop()
+    await job_queue.stop(setting.job_queue_drain_timeout)
+    shutdown_hash_pools()
+    if rate_limit_backend is not None:
+        await rate_limit_backend.close()
+    disconnect()
+
+app=FastAPI(lifespan=lifespan)
 
 origins = [
     "https://adarsh-utd.github.io/library-management-system-web",
     "*"]
 
+app.add_middleware(
+    RateLimitMiddleware,
+    backend=rate_limit_backend,
+    routes={route:parse_rules(rules) for route,rules in setting.rate_limits.items()},
+    trust_forwarded=setting.rate_limit_trust_forwarded,
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -17,9 +75,13 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, slow_request_ms=setting.slow_request_ms)
 app.include_router(auth.auth_router)
 app.include_router(books.book_router)
 app.include_router(members.member_router)
+app.include_router(loans.loan_router)
+app.include_router(stats.stats_router)
+app.include_router(metrics.metrics_router)
 
 if __name__ == '__main__':
-    uvicorn.run(app=app, host='localhost', port=8000)
\ No newline at end of file
+    uvicorn.run(app=app, host='localhost', port=8000, timeout_graceful_shutdown=10)
\ No newline at end of file
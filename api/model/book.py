@@ -6,6 +6,7 @@ from typing import Optional
 from pydantic import BaseModel, Field
 
 from api.model.base import PyObjectId
+from api.utils.serializer import DocumentSerializer
 
 
 class BooksRequestBody(BaseModel):
@@ -13,6 +14,7 @@ class BooksRequestBody(BaseModel):
     description:str
     author:str
     genre:str
+    total_copies:int=Field(1,ge=1)
 
     class Config:
         schema_extra = {
@@ -20,7 +22,8 @@ class BooksRequestBody(BaseModel):
                 "name": "Angels & demons",
                 "description": "Fiction books",
                 "author":"Dan brown",
-                "genre":"Fiction"
+                "genre":"Fiction",
+                "total_copies":1
             }
         }
 
@@ -34,6 +37,8 @@ class Books(BaseModel):
     author: str
     genre: str
     status:str=BookStatus.available
+    total_copies:int=1
+    available_copies:int=1
     created_ts:int
     returned_ts: Optional[int] = 0
     borrowed_ts: Optional[int] = 0
@@ -60,7 +65,9 @@ class Books(BaseModel):
             "borrowed_by": self.borrowed_by_name,
             "borrow_by_id":str(self.borrowed_by_id),
             "borrowed_ts": self.borrowed_ts,
-            "returned_ts": self.returned_ts
+            "returned_ts": self.returned_ts,
+            "total_copies": self.total_copies,
+            "available_copies": self.available_copies
         }
 
     def detailed_response(self):
@@ -70,11 +77,21 @@ class Books(BaseModel):
             "description":self.description,
             "author": self.author,
             "genre": self.genre,
+            "total_copies": self.total_copies,
+            "available_copies": self.available_copies
         }
 
 
-
-
-
-
-
+list_books_serializer = DocumentSerializer([
+    ("id", "_id", None, str),
+    ("name", "name", None, None),
+    ("author", "author", None, None),
+    ("genre", "genre", None, None),
+    ("status", "status", BookStatus.available.value, None),
+    ("borrowed_by", "borrowed_by_name", "", None),
+    ("borrow_by_id", "borrowed_by_id", None, str),
+    ("borrowed_ts", "borrowed_ts", 0, None),
+    ("returned_ts", "returned_ts", 0, None),
+    ("total_copies", "total_copies", 1, None),
+    ("available_copies", "available_copies", 1, None)
+])
@@ -0,0 +1,18 @@
+from enum import Enum
+
+from api.utils.serializer import DocumentSerializer
+
+
+class BookLogAction(str,Enum):
+    borrow="BORROW"
+    returned="RETURN"
+    overdue="OVERDUE"
+
+
+history_serializer = DocumentSerializer([
+    ("id", "_id", None, str),
+    ("book_id", "book_id", None, str),
+    ("book_name", "book_name", "", None),
+    ("action", "action", None, None),
+    ("ts", "ts", None, None)
+])
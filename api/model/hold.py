@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class HoldStatus(str,Enum):
+    waiting="WAITING"
+    fulfilled="FULFILLED"
+    cancelled="CANCELLED"
@@ -0,0 +1,20 @@
+from enum import Enum
+
+from api.utils.serializer import DocumentSerializer
+
+
+class LoanStatus(str,Enum):
+    active="ACTIVE"
+    returned="RETURNED"
+
+
+overdue_loan_serializer = DocumentSerializer([
+    ("id", "_id", None, str),
+    ("book_id", "book_id", None, str),
+    ("book_name", "book_name", "", None),
+    ("member_id", "member_id", None, str),
+    ("member_name", "member_name", "", None),
+    ("borrowed_ts", "borrowed_ts", 0, None),
+    ("due_ts", "due_ts", 0, None),
+    ("overdue_ts", "overdue_ts", 0, None)
+])
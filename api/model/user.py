@@ -3,6 +3,7 @@ from enum import Enum
 from pydantic import BaseModel, Field, EmailStr
 
 from api.model.base import PyObjectId
+from api.utils.serializer import DocumentSerializer, normalized_email
 
 
 class UserType(str,Enum):
@@ -64,6 +65,15 @@ class Users(BaseModel):
         }
 
 
+list_members_serializer = DocumentSerializer([
+    ("id", "_id", None, str),
+    ("username", "username", None, None),
+    ("address", "address", None, None),
+    ("email", "email", None, normalized_email),
+    ("status", "is_deleted", False, lambda is_deleted: "Deleted" if is_deleted else "Active")
+])
+
+
 class LoginResponseModel(BaseModel):
     id: str
     username: str
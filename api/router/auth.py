@@ -5,11 +5,16 @@ from fastapi.security import OAuth2PasswordRequestForm
 from starlette import status
 from starlette.responses import JSONResponse
 
-from api.auth.authenticate import authenticate_user, authenticate
+from api.auth.authenticate import authenticate_user, authenticate, user_cache
 from api.auth.hash_password import HashPassword
-from api.auth.jwt_handler import create_access_token
-from api.database.connection import  users_collection
+from api.auth.jwt_handler import create_access_token, token_claims
+from api.auth.token_revocation import revoke_tokens
+from api.database.catalogue_stats import record_stats, user_increments
+from api.database.connection import  users_collection, holds_collection
+from api.model.hold import HoldStatus
 from api.model.user import Users, LoginResponseModel, AddUserModel, UserType
+from api.utils.response_cache import response_cache
+from api.utils.utils import get_timestamp
 
 auth_router = APIRouter(
     tags=['Authentication'],
@@ -37,7 +42,7 @@ If credentials is valid a json response is returned that contain JWT token
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = create_access_token(user={"sub": user.get("username")})
+    access_token = create_access_token(user=token_claims(user))
     response_model = LoginResponseModel(
         id=str(user.get("_id")),
         username=user.get("username"),
@@ -69,7 +74,7 @@ async def signup(user:AddUserModel=Body(...))-> JSONResponse:
             detail="username already exist",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    hash_p=hash_password.create_password_hash(user.password)
+    hash_p=await hash_password.create_password_hash_async(user.password)
     user.password=hash_p
     insert_user={
         "username" :user.username,
@@ -80,7 +85,9 @@ async def signup(user:AddUserModel=Body(...))-> JSONResponse:
         "is_deleted": False
     }
     inserted_user=await users_collection.insert_one(insert_user)
-    access_token = create_access_token(user={"sub": user.username})
+    await response_cache.invalidate("members")
+    await record_stats(user_increments(insert_user["user_type"],1))
+    access_token = create_access_token(user=token_claims({**insert_user,"_id":inserted_user.inserted_id}))
     response_model=LoginResponseModel(
         id=str(inserted_user.inserted_id),
         username=user.username,
@@ -107,7 +114,12 @@ async def delete_my_account(user: object = Depends(authenticate)) -> JSONRespons
             detail="User not allowed to perform this action.",
 
         )
-    await users_collection.update_one({"_id": ObjectId(user.get("_id"))}, {"$set": {"is_deleted": True}})
+    await revoke_tokens(ObjectId(user.get("_id")), {"is_deleted": True})
+    await holds_collection.update_many({"member_id": ObjectId(user.get("_id")), "status": HoldStatus.waiting},
+                                       {"$set": {"status": HoldStatus.cancelled, "cancelled_ts": get_timestamp()}})
+    user_cache.invalidate(user.get("username"))
+    await response_cache.invalidate("members")
+    await record_stats(user_increments(user.get("user_type"), -1))
     response = {
         "message": "Account deleted successfully"
     }
@@ -1,13 +1,35 @@
+import functools
+from typing import Optional
+
 from bson import ObjectId
-from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi import APIRouter, Depends, HTTPException, Body, Query, Request
+from pydantic import ValidationError
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse, Response
 
 from api.auth.authenticate import authenticate
-from api.database.connection import books_collection, book_logs_collection
+from api.database.book_log_writer import book_log_writer
+from api.database.catalogue_stats import record_stats, book_increments, status_increments, copies_increments, \
+    overdue_increments, STATUS, GENRE, AUTHOR
+from api.database.connection import books_collection, read_collection, loans_collection, holds_collection, \
+    CACHE_FILL_READS
+from api.database.lending import SET_STATUS_FROM_COPIES, catalogue_version, book_changed, hand_off_copy, serve_holds, \
+    in_transaction
+from api.database.overdue_sweeper import due_ts_of, fine_expression
 from api.model.base import PyObjectId
-from api.model.book import BooksRequestBody, Books, BookStatus
+from api.model.book_log import BookLogAction
+from api.model.book import BooksRequestBody, Books, BookStatus, list_books_serializer
+from api.model.hold import HoldStatus
+from api.model.loan import LoanStatus
 from api.model.user import UserType
+from api.utils.event_hub import book_events, HubFull
+from api.utils.http_cache import make_etag, matches_if_none_match, not_modified_response, \
+    cache_headers
+from api.utils.upload import upload_format_of, iter_records, validation_messages, BulkReport
+from api.utils.response_cache import response_cache
+from api.utils.serializer import dump_json, raw_json_response
 from api.utils.utils import get_timestamp
 
 book_router = APIRouter(
@@ -16,6 +38,28 @@ book_router = APIRouter(
         "description": "Not found"
     }},
 )
+BOOKS_PAGE_SIZE=100
+BOOKS_MAX_PAGE_SIZE=1000
+BOOKS_STREAM_BATCH_SIZE=500
+BULK_BATCH_SIZE=1000
+BULK_MAX_BATCH_SIZE=10000
+BULK_MAX_ERRORS=1000
+SEARCH_PAGE_SIZE=20
+SEARCH_MAX_SKIP=10000
+SEARCH_FACET_SIZE=20
+books_page_reads=read_collection("books","get_all_books")
+books_stream_reads=read_collection("books","stream_all_books")
+books_search_reads=read_collection("books","search_books")
+books_detail_reads=read_collection("books","get_book_by_id")
+books_cache_fill_reads=read_collection("books",CACHE_FILL_READS)
+search_counter_reads=read_collection("stats","search_books")
+stats_cache_fill_reads=read_collection("stats",CACHE_FILL_READS)
+
+
+async def _catalogue_changed():
+    await catalogue_version.bump()
+    await response_cache.invalidate("books")
+
 
 @book_router.post("/books")
 async def create_book(book:BooksRequestBody=Body(...),user:object=Depends(authenticate))->JSONResponse:
@@ -33,15 +77,22 @@ async def create_book(book:BooksRequestBody=Body(...),user:object=Depends(authen
             detail="User not allowed to perform this action.",
 
         )
+    now=get_timestamp()
     insert_book={
         "name":book.name,
         "description":book.description,
-        "created_ts":get_timestamp(),
+        "created_ts":now,
+        "updated_ts":now,
         "author":book.author,
         "genre":book.genre,
+        "total_copies":book.total_copies,
+        "available_copies":book.total_copies,
         "is_deleted":False
     }
     await books_collection.insert_one(insert_book)
+    await _catalogue_changed()
+    book_changed(insert_book)
+    await record_stats(book_increments(insert_book,1))
     response={
            "message":"Book added successfully"
        }
@@ -49,19 +100,237 @@ async def create_book(book:BooksRequestBody=Body(...),user:object=Depends(authen
                            content=response)
 
 
+@book_router.post("/books/bulk")
+async def bulk_create_books(request:Request,
+                            batch_size:int=Query(BULK_BATCH_SIZE,ge=1,le=BULK_MAX_BATCH_SIZE),
+                            user:object=Depends(authenticate))->JSONResponse:
+    """
+    This endpoint allow librarian user to import many books from a streamed csv or ndjson upload.
+    Rows are validated as BooksRequestBody while the body is received and inserted in batches.
+    A csv upload needs a header row with name, description, author and genre columns,
+    total_copies is optional.
+    :param request (Request): The upload, with content type text/csv or application/x-ndjson.
+    :param batch_size (int): Number of books written per insert.
+    :param user (object):  An authenticated user object retrieved  through dependency injection.
+    :return JSONResponse:  A JSON response that contains status code 200 and content which contains
+    number of inserted and failed rows and the errors of the failed rows.
+    :raise HTTPException:
+    - 403 forbidden :   If user is member
+    - 415 unsupported media type : If upload is neither csv nor ndjson
+    """
+    if user.get("user_type")!=UserType.librarian:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
+
+        )
+    upload_format=upload_format_of(request)
+    report=BulkReport(BULK_MAX_ERRORS)
+    batch=[]
+    rows=[]
+    async for row,record,error in iter_records(request,upload_format):
+        if error:
+            report.add_error(row,error)
+            continue
+        if record.get("total_copies")=="":
+            # blank cell of the optional csv column
+            del record["total_copies"]
+        try:
+            book=BooksRequestBody(**record)
+        except ValidationError as validation_error:
+            report.add_error(row,validation_messages(validation_error))
+            continue
+        now=get_timestamp()
+        batch.append({
+            "name":book.name,
+            "description":book.description,
+            "created_ts":now,
+            "updated_ts":now,
+            "author":book.author,
+            "genre":book.genre,
+            "total_copies":book.total_copies,
+            "available_copies":book.total_copies,
+            "is_deleted":False
+        })
+        rows.append(row)
+        if len(batch)>=batch_size:
+            await _insert_books(batch,rows,report)
+            batch,rows=[],[]
+    if batch:
+        await _insert_books(batch,rows,report)
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content=report.as_dict())
+
+
+async def _insert_books(batch:list,rows:list,report:BulkReport):
+    failed=set()
+    try:
+        result=await books_collection.insert_many(batch,ordered=False)
+        report.inserted+=len(result.inserted_ids)
+    except BulkWriteError as error:
+        report.inserted+=error.details.get("nInserted",0)
+        for write_error in error.details["writeErrors"]:
+            failed.add(write_error["index"])
+            report.add_error(rows[write_error["index"]],write_error.get("errmsg","Insert failed"))
+    await _catalogue_changed()
+    inserted=[book for index,book in enumerate(batch) if index not in failed]
+    if inserted:
+        # one event per batch, an import would otherwise overflow the buffer of every client
+        book_events.publish("catalogue",{"inserted":len(inserted)})
+    await record_stats([x for book in inserted for x in book_increments(book,1)])
+
+
 @book_router.get("/books")
-async def get_all_books(user:object=Depends(authenticate))->dict:
+async def get_all_books(request:Request,
+                        limit:Optional[int]=Query(None,ge=1,le=BOOKS_MAX_PAGE_SIZE),
+                        after:Optional[PyObjectId]=None,
+                        stream:bool=False,
+                        user:object=Depends(authenticate))->Response:
+    """
+    This endpoint list down books available in the system, ordered by id and paginated with a cursor.
+    Pages carry an ETag of the catalogue version, a matching If-None-Match is answered with 304.
+    :param request (Request): The request, read for its If-None-Match header.
+    :param limit (int): Maximum number of books in the page. Defaults to 100 and is unbounded when streaming.
+    :param after (PyObjectId): Cursor returned as next_cursor by the previous page.
+    :param stream (bool): If true the books are written as NDJSON, one per line, while the cursor produces them.
+    :param user:  An authenticated user object retrieved  through dependency injection.
+    :return (dict): A dict that contains list of books and next_cursor (None on the last page)
+    """
+    query={"is_deleted":False}
+    if after:
+        query["_id"]={"$gt":ObjectId(after)}
+    if stream:
+        cursor=books_stream_reads.find(query,list_books_serializer.projection).sort("_id",1)
+        if limit:
+            cursor=cursor.limit(limit)
+        return StreamingResponse(_stream_books(cursor.batch_size(BOOKS_STREAM_BATCH_SIZE)),
+                                 media_type="application/x-ndjson")
+    limit=limit or BOOKS_PAGE_SIZE
+    version,modified_ts=await catalogue_version.current()
+    etag=make_etag(version,"books",limit,after)
+    if matches_if_none_match(request,etag):
+        return not_modified_response(etag,modified_ts)
+    cached=await response_cache.lookup("books","get_all_books",limit,after)
+    if cached.body is not None:
+        return raw_json_response(cached.body,headers=cache_headers(etag,modified_ts))
+    books=await books_page_reads.find(query,list_books_serializer.projection).sort("_id",1) \
+        .limit(limit+1).to_list(limit+1)
+    next_cursor=None
+    if len(books)>limit:
+        books=books[:limit]
+        next_cursor=str(books[-1]["_id"])
+    response={
+        "books":[list_books_serializer(x) for x in books],
+        "next_cursor":next_cursor
+    }
+    body=dump_json(response)
+    await response_cache.store(cached,body)
+    return raw_json_response(body,headers=cache_headers(etag,modified_ts))
+
+
+async def _stream_books(cursor):
+    async for book in cursor:
+        yield dump_json(list_books_serializer(book))+b"\n"
+
+
+@book_router.get("/books/search")
+async def search_books(q:Optional[str]=Query(None,min_length=1),
+                       genre:Optional[str]=None,
+                       author:Optional[str]=None,
+                       book_status:Optional[BookStatus]=Query(None,alias="status"),
+                       limit:int=Query(SEARCH_PAGE_SIZE,ge=1,le=BOOKS_MAX_PAGE_SIZE),
+                       skip:int=Query(0,ge=0,le=SEARCH_MAX_SKIP),
+                       user:object=Depends(authenticate))->Response:
     """
-    This endpoint list down all books available in the system
+    This endpoint search books by text over name, author, description and genre, ranked by relevance.
+    Results can be narrowed with facet filters and the response carries the facet counts of the matched books.
+    :param q (str): Free text query. If omitted, books are only filtered by facets and ordered by id.
+    Without query and filters, the total and facet counts are those of the catalogue statistics counters.
+    :param genre (str): Only books of this genre.
+    :param author (str): Only books of this author.
+    :param book_status (BookStatus): Only books with this status, passed as status.
+    :param limit (int): Maximum number of books in the page.
+    :param skip (int): Number of matched books to skip.
     :param user:  An authenticated user object retrieved  through dependency injection.
-    :return (dict): A dict that contains list of books
+    :return (dict): A dict that contains the page of books, total number of matches and facet counts.
     """
-    books= await books_collection.find({"is_deleted":False}).to_list(None)
-    books=[Books(**x).list_books() for x in books]
+    cached=await response_cache.lookup("books","search_books",q,genre,author,book_status,limit,skip)
+    if cached.body is not None:
+        return raw_json_response(cached.body)
+    if not (q or genre or author or book_status):
+        body=dump_json(await _catalogue_page(limit,skip,cached.cacheable))
+        await response_cache.store(cached,body)
+        return raw_json_response(body)
+    match={"is_deleted":False}
+    if q:
+        match["$text"]={"$search":q}
+    if genre:
+        match["genre"]=genre
+    if author:
+        match["author"]=author
+    if book_status==BookStatus.available:
+        match["status"]={"$ne":BookStatus.borrowed}
+    elif book_status:
+        match["status"]=book_status
+    pipeline=[{"$match":match}]
+    if q:
+        pipeline.append({"$addFields":{"score":{"$meta":"textScore"}}})
+        sort={"$sort":{"score":-1,"_id":1}}
+    else:
+        sort={"$sort":{"_id":1}}
+    pipeline.append({"$facet":{
+        "books":[sort,{"$skip":skip},{"$limit":limit},{"$project":{**list_books_serializer.projection,"score":1}}],
+        "total":[{"$count":"count"}],
+        "genre":_facet_counts("$genre"),
+        "author":_facet_counts("$author"),
+        "status":_facet_counts({"$ifNull":["$status",BookStatus.available.value]})
+    }})
+    reads=books_cache_fill_reads if cached.cacheable else books_search_reads
+    result=(await reads.aggregate(pipeline).to_list(1))[0]
+    books=[]
+    for book in result["books"]:
+        listed=list_books_serializer(book)
+        if q:
+            listed["score"]=book["score"]
+        books.append(listed)
     response={
-        "books":books
+        "books":books,
+        "total":result["total"][0]["count"] if result["total"] else 0,
+        "facets":{
+            facet:[{"value":x["_id"],"count":x["count"]} for x in result[facet]]
+            for facet in ("genre","author","status")
+        }
+    }
+    body=dump_json(response)
+    await response_cache.store(cached,body)
+    return raw_json_response(body)
+
+
+async def _catalogue_page(limit:int,skip:int,cacheable:bool)->dict:
+    """Search without query or filter. Grouping the whole catalogue would cost every book on every request,
+    the page is read from the is_deleted/_id index and the counts from the statistics counters instead."""
+    reads,counter_reads=(books_cache_fill_reads,stats_cache_fill_reads) if cacheable \
+        else (books_search_reads,search_counter_reads)
+    books=await reads.find({"is_deleted":False},list_books_serializer.projection).sort("_id",1) \
+        .skip(skip).limit(limit).to_list(limit)
+    facets={}
+    for facet,dimension in (("genre",GENRE),("author",AUTHOR),("status",STATUS)):
+        counters=await counter_reads.find({"dimension":dimension,"count":{"$gt":0}}) \
+            .sort([("count",-1),("value",1)]).limit(SEARCH_FACET_SIZE).to_list(SEARCH_FACET_SIZE)
+        facets[facet]=[{"value":x["value"],"count":x["count"]} for x in counters]
+    return {
+        "books":[list_books_serializer(x) for x in books],
+        "total":sum(x["count"] for x in facets["status"]),
+        "facets":facets
     }
-    return response
+
+
+def _facet_counts(expression)->list:
+    return [
+        {"$group":{"_id":expression,"count":{"$sum":1}}},
+        {"$sort":{"count":-1,"_id":1}},
+        {"$limit":SEARCH_FACET_SIZE}
+    ]
 
 
 @book_router.put("/books/{book_id}")
@@ -76,6 +345,7 @@ async def update_book(book_id:PyObjectId,book_request:BooksRequestBody,user:obje
     :raise HTTPException:
     - 403 forbidden :   If user is member
     - 404 not found : If book with specified id doesn't exist
+    - 409 conflict : If total_copies is lower than the number of copies on loan
     """
     if user.get("user_type") != UserType.librarian:
         raise HTTPException(
@@ -88,20 +358,62 @@ async def update_book(book_id:PyObjectId,book_request:BooksRequestBody,user:obje
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
     query={
-        "_id":ObjectId(book_id)
+        "_id":ObjectId(book_id),
+        # copies on loan can't be removed
+        "$expr":{"$gte":[book_request.total_copies,{"$subtract":["$total_copies","$available_copies"]}]}
     }
-    await books_collection.update_one(query,{"$set":book_request.__dict__})
+    details={field:{"$literal":value} for field,value in book_request.__dict__.items() if field!="total_copies"}
+    updated=await books_collection.find_one_and_update(query,[{"$set":{
+        **details,
+        "available_copies":{"$add":["$available_copies",{"$subtract":[book_request.total_copies,"$total_copies"]}]},
+        "total_copies":book_request.total_copies,
+        "updated_ts":get_timestamp()
+    }},SET_STATUS_FROM_COPIES],return_document=ReturnDocument.AFTER)
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="More copies are on loan than total_copies")
+    if not book.get("is_deleted"):
+        await record_stats(book_increments(book,-1)+book_increments(updated,1))
+        # added copies go to the members waiting for the book before anybody else can borrow them
+        if updated["available_copies"]>book.get("available_copies",1):
+            updated=await serve_holds(updated["_id"],updated["updated_ts"]) or updated
+    await _catalogue_changed()
+    book_changed(updated)
     response={
         "message":"Updated successfully"
     }
     return JSONResponse(status_code=status.HTTP_200_OK,
                         content=response)
 
+@book_router.get("/books/events")
+async def get_book_events(user:object=Depends(authenticate))->StreamingResponse:
+    """
+    This endpoint streams availability changes of books as server-sent events, so clients don't have to poll
+    the catalogue. Each book event has data {book_id, status, available_copies, borrowed_by, deleted}.
+    A bulk import sends one catalogue event {inserted} per batch instead, after which the books should be fetched again.
+    A client that falls book_events_buffer_size events behind gets an evicted event and is disconnected,
+    it should fetch the books again before reconnecting. Events are those of the worker the client is connected to.
+    :param user (object):  An authenticated user object retrieved  through dependency injection.
+    :return StreamingResponse:  A text/event-stream response.
+    :raise HTTPException:
+    - 503 service unavailable : If book_events_max_clients clients are connected
+    """
+    try:
+        subscriber=book_events.subscribe()
+    except HubFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many event clients")
+    return StreamingResponse(book_events.stream(subscriber),media_type="text/event-stream",
+                             headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
+
+
 @book_router.get("/books/{book_id}")
-async def get_book_by_id(book_id:PyObjectId,user:object=Depends(authenticate))->JSONResponse:
+async def get_book_by_id(book_id:PyObjectId,request:Request,user:object=Depends(authenticate))->Response:
     """
     This endpoint retrieve specified book by its ID
+    The response carries an ETag of the catalogue version, a matching If-None-Match is answered with 304.
     :param book_id (PyObjectId): The unique identifier of the book.
+    :param request (Request): The request, read for its If-None-Match header.
     :param user (object):  An authenticated user object retrieved  through dependency injection.
     :return JSONResponse:  A JSON response that contains status code 200 and content which contains success message.
     :raise HTTPException:
@@ -114,15 +426,27 @@ async def get_book_by_id(book_id:PyObjectId,user:object=Depends(authenticate))->
             detail="User not allowed to perform this action.",
 
         )
-    book= await books_collection.find_one({"_id":ObjectId(book_id)})
+    version,modified_ts=await catalogue_version.current()
+    etag=make_etag(version,"book",book_id)
+    if matches_if_none_match(request,etag):
+        return not_modified_response(etag,modified_ts)
+    # cached entries carry the book's updated_ts, its Last-Modified, in front of the body
+    cached=await response_cache.lookup("books","get_book_by_id",book_id,"updated_ts")
+    if cached.body is not None:
+        updated_ts,_,body=cached.body.partition(b"\n")
+        return raw_json_response(body,headers=cache_headers(etag,int(updated_ts)))
+    book= await books_detail_reads.find_one({"_id":ObjectId(book_id)})
     if not book:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
+    updated_ts=book.get("updated_ts",book.get("created_ts",0))
     book=Books(**book).detailed_response()
     response={
         "book":book
     }
-    return response
+    body=dump_json(response)
+    await response_cache.store(cached,b"%d\n"%updated_ts+body)
+    return raw_json_response(body,headers=cache_headers(etag,updated_ts))
 
 @book_router.delete("/books/{book_id}")
 async def remove_book(book_id:PyObjectId,user:object=Depends(authenticate))->JSONResponse:
@@ -149,7 +473,12 @@ async def remove_book(book_id:PyObjectId,user:object=Depends(authenticate))->JSO
     query = {
         "_id": ObjectId(book_id)
     }
-    await books_collection.update_one(query, {"$set":{"is_deleted":True} })
+    await books_collection.update_one(query, {"$set":{"is_deleted":True,"updated_ts":get_timestamp()} })
+    await holds_collection.update_many({"book_id":ObjectId(book_id),"status":HoldStatus.waiting},
+                                       {"$set":{"status":HoldStatus.cancelled,"cancelled_ts":get_timestamp()}})
+    await _catalogue_changed()
+    book_changed({**book,"is_deleted":True})
+    await record_stats(book_increments(book,-1))
     response = {
         "message": "Deleted successfully"
     }
@@ -159,16 +488,68 @@ async def remove_book(book_id:PyObjectId,user:object=Depends(authenticate))->JSO
 @book_router.post("/books/{book_id}/borrow-return/{borrow_status}")
 async def borrow_return_book(book_id:PyObjectId,borrow_status:bool,user:object=Depends(authenticate))->JSONResponse:
     """
-    This endpoint allow members to borrow or return existing books
+    This endpoint allow members to borrow or return a copy of existing books
    :param book_id (PyObjectId): The unique identifier of the book.
     :param user (object):  An authenticated user object retrieved  through dependency injection.
     :param borrow_status (bool): A boolean value that represent the action to be performed.
     - True: if member is borrowing book
-    - False : if member is returning book
-     :return JSONResponse:  A JSON response that contains status code 201 and content which contains success message.
+    - False : if member is returning book, the copy goes to the first member holding the book if there is one
+     :return JSONResponse:  A JSON response that contains status code 201 and content which contains success message
+     and the due date of a borrowed copy or the fine of a returned one.
+    :raise HTTPException:
+    - 403 forbidden :   If user is librarian
+    - 404 not found : If book with specified id doesn't exist
+    - 409 conflict : If no copy is available, the member already has a copy, or returns a book they haven't borrowed
+    """
+    if user.get("user_type") != UserType.member:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
+
+        )
+    member_id=ObjectId(user.get("_id"))
+    now=get_timestamp()
+    if borrow_status:
+        book_status = BookStatus.borrowed
+        book=await _borrow_copy(ObjectId(book_id),member_id,user.get("username"),now)
+        details={"due_ts":due_ts_of(now)}
+    else:
+        book_status = BookStatus.available
+        book,fine=await _return_copy(ObjectId(book_id),member_id,now)
+        details={"fine":fine}
+    await _catalogue_changed()
+    if "status" in book:
+        book_changed(book)
+    book_log_writer.append({
+        "member_id":member_id,
+        "member_name":user.get("username"),
+        "book_id":book["_id"],
+        "book_name":book.get("name"),
+        "action":BookLogAction.borrow if borrow_status else BookLogAction.returned,
+        "ts":now
+    })
+
+    response = {
+        "message": f"{book_status.value.capitalize() if book_status.value==BookStatus.borrowed else 'Returned'} successfully",
+        **details
+    }
+    return JSONResponse(status_code=status.HTTP_201_CREATED,
+                        content=response)
+
+
+@book_router.post("/books/{book_id}/hold")
+async def place_hold(book_id:PyObjectId,user:object=Depends(authenticate))->JSONResponse:
+    """
+    This endpoint allow members to queue for a book that has no available copy.
+    Holds are served first come first served, a returned copy is lent to the first member in the queue.
+    :param book_id (PyObjectId): The unique identifier of the book.
+    :param user (object):  An authenticated user object retrieved  through dependency injection.
+    :return JSONResponse:  A JSON response that contains status code 201 and content which contains success message
+    and position in the queue, or the due date when a copy that came back meanwhile was lent to the member.
     :raise HTTPException:
     - 403 forbidden :   If user is librarian
     - 404 not found : If book with specified id doesn't exist
+    - 409 conflict : If a copy is available, or the member already has a copy or a hold of the book
     """
     if user.get("user_type") != UserType.member:
         raise HTTPException(
@@ -176,35 +557,210 @@ async def borrow_return_book(book_id:PyObjectId,borrow_status:bool,user:object=D
             detail="User not allowed to perform this action.",
 
         )
-    book = await books_collection.find_one({"_id": ObjectId(book_id), "is_deleted": False})
+    member_id=ObjectId(user.get("_id"))
+    book=await books_collection.find_one({"_id":ObjectId(book_id),"is_deleted":False},{"name":1,"available_copies":1})
     if not book:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
-
-    query = {
-        "_id": ObjectId(book_id)
+    if book.get("available_copies",1)>0:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="A copy of the book is available")
+    if await loans_collection.find_one({"book_id":book["_id"],"member_id":member_id,"status":LoanStatus.active},{"_id":1}):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Book is already borrowed by this member")
+    hold={
+        "book_id":book["_id"],
+        "book_name":book.get("name"),
+        "member_id":member_id,
+        "member_name":user.get("username"),
+        "created_ts":get_timestamp(),
+        "status":HoldStatus.waiting
     }
-    update_borrow_details={
+    try:
+        await holds_collection.insert_one(hold)
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Book is already on hold for this member")
+    # a copy returned between the check above and the insert found nobody waiting and became available
+    served=await serve_holds(book["_id"],hold["created_ts"])
+    if served:
+        await _catalogue_changed()
+        book_changed(served)
+    if await holds_collection.find_one({"_id":hold["_id"],"status":HoldStatus.fulfilled},{"_id":1}):
+        response={
+            "message":"Borrowed successfully",
+            "due_ts":due_ts_of(hold["created_ts"])
+        }
+    else:
+        response={
+            "message":"Hold placed successfully",
+            "position":await _hold_position(hold)
+        }
+    return JSONResponse(status_code=status.HTTP_201_CREATED,
+                        content=response)
+
 
-        "borrowed_by_id":ObjectId(user.get("_id")),
-        "borrowed_by_name":user.get("username")
+@book_router.get("/books/{book_id}/hold")
+async def get_hold(book_id:PyObjectId,user:object=Depends(authenticate))->JSONResponse:
+    """
+    This endpoint return the position of the member in the hold queue of a book
+    :param book_id (PyObjectId): The unique identifier of the book.
+    :param user (object):  An authenticated user object retrieved  through dependency injection.
+    :return JSONResponse:  A JSON response that contains status code 200 and content which contains
+    position in the queue, queue length and the time the hold was placed.
+    :raise HTTPException:
+    - 403 forbidden :   If user is librarian
+    - 404 not found : If member has no hold of the book
+    """
+    if user.get("user_type") != UserType.member:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
 
+        )
+    hold=await holds_collection.find_one({"book_id":ObjectId(book_id),"member_id":ObjectId(user.get("_id")),
+                                          "status":HoldStatus.waiting})
+    if not hold:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Hold not found")
+    response={
+        "position":await _hold_position(hold),
+        "queue_length":await holds_collection.count_documents({"book_id":hold["book_id"],
+                                                               "status":HoldStatus.waiting}),
+        "created_ts":hold["created_ts"]
     }
-    if borrow_status:
-        book_status = BookStatus.borrowed
-        update_borrow_details["borrowed_ts"]=get_timestamp()
-        update_borrow_details["returned_ts"] =0
-        update_borrow_details["status"]=BookStatus.borrowed
-    else:
-        update_borrow_details["returned_ts"] = get_timestamp()
-        update_borrow_details["status"] = BookStatus.available
-        book_status = BookStatus.available
-    await books_collection.update_one(query, {"$set": update_borrow_details})
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content=response)
 
-    response = {
-        "message": f"{book_status.value.capitalize() if book_status.value==BookStatus.borrowed else 'Returned'} successfully"
+
+@book_router.delete("/books/{book_id}/hold")
+async def cancel_hold(book_id:PyObjectId,user:object=Depends(authenticate))->JSONResponse:
+    """
+    This endpoint allow members to leave the hold queue of a book
+    :param book_id (PyObjectId): The unique identifier of the book.
+    :param user (object):  An authenticated user object retrieved  through dependency injection.
+    :return JSONResponse:  A JSON response that contains status code 200 and content which contains success message.
+    :raise HTTPException:
+    - 403 forbidden :   If user is librarian
+    - 404 not found : If member has no hold of the book
+    """
+    if user.get("user_type") != UserType.member:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
+
+        )
+    result=await holds_collection.update_one(
+        {"book_id":ObjectId(book_id),"member_id":ObjectId(user.get("_id")),"status":HoldStatus.waiting},
+        {"$set":{"status":HoldStatus.cancelled,"cancelled_ts":get_timestamp()}})
+    if not result.matched_count:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Hold not found")
+    response={
+        "message":"Hold cancelled successfully"
     }
-    return JSONResponse(status_code=status.HTTP_201_CREATED,
+    return JSONResponse(status_code=status.HTTP_200_OK,
                         content=response)
 
 
+async def _hold_position(hold:dict)->int:
+    # holds placed in the same millisecond are ordered by _id
+    return await holds_collection.count_documents({
+        "book_id":hold["book_id"],
+        "status":HoldStatus.waiting,
+        "$or":[{"created_ts":{"$lt":hold["created_ts"]}},
+               {"created_ts":hold["created_ts"],"_id":{"$lt":hold["_id"]}}]
+    })+1
+
+
+async def _borrow_copy(book_id:ObjectId,member_id:ObjectId,username:str,now:int)->dict:
+    """Takes one available copy and opens a loan for it. The copy is taken by a single conditional update,
+    so concurrent borrowers can never take more copies than there are."""
+    book=await books_collection.find_one_and_update(
+        {"_id":book_id,"is_deleted":False,"available_copies":{"$gt":0}},
+        [{"$set":{
+            "available_copies":{"$subtract":["$available_copies",1]},
+            "borrow_count":{"$add":[{"$ifNull":["$borrow_count",0]},1]},
+            "borrowed_by_id":member_id,
+            "borrowed_by_name":{"$literal":username},
+            "borrowed_ts":now,
+            "updated_ts":now
+        }},SET_STATUS_FROM_COPIES],
+        projection={"_id":1,"name":1,"available_copies":1,"status":1,"borrowed_by_name":1},
+        return_document=ReturnDocument.AFTER)
+    if not book:
+        if not await books_collection.find_one({"_id":book_id,"is_deleted":False},{"_id":1}):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="No copy of the book is available")
+    try:
+        await loans_collection.insert_one({
+            "book_id":book_id,
+            "book_name":book.get("name"),
+            "member_id":member_id,
+            "member_name":username,
+            "borrowed_ts":now,
+            "due_ts":due_ts_of(now),
+            "returned_ts":0,
+            "status":LoanStatus.active
+        })
+    except DuplicateKeyError:
+        # the member already holds a copy of this title, put the copy back
+        await books_collection.update_one({"_id":book_id},[{"$set":{
+            "available_copies":{"$add":["$available_copies",1]},
+            "borrow_count":{"$subtract":["$borrow_count",1]}
+        }},SET_STATUS_FROM_COPIES])
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Book is already borrowed by this member")
+    # a copy added to the title can be borrowed by a member still waiting in the queue
+    await holds_collection.update_one({"book_id":book_id,"member_id":member_id,"status":HoldStatus.waiting},
+                                      {"$set":{"status":HoldStatus.fulfilled,"fulfilled_ts":now}})
+    increments=copies_increments(1)
+    if book["available_copies"]==0:
+        increments+=status_increments(BookStatus.available.value,BookStatus.borrowed.value)
+    await record_stats(increments)
+    return book
+
+
+async def _return_copy(book_id:ObjectId,member_id:ObjectId,now:int)->tuple:
+    """Closes the member's loan of the book together with its fine, and hands the copy to the first member
+    waiting or puts it back, in one transaction where the deployment has them. Returns the book and the fine."""
+    return await in_transaction(functools.partial(_close_loan,book_id,member_id,now))
+
+
+async def _close_loan(book_id:ObjectId,member_id:ObjectId,now:int,session,effects:list)->tuple:
+    loan=await loans_collection.find_one_and_update(
+        {"book_id":book_id,"member_id":member_id,"status":LoanStatus.active},
+        [{"$set":{"status":LoanStatus.returned.value,"returned_ts":now,"fine":fine_expression(now)}}],
+        projection={"_id":1,"fine":1,"overdue_ts":1},
+        return_document=ReturnDocument.AFTER,
+        session=session)
+    if not loan:
+        if not await books_collection.find_one({"_id":book_id,"is_deleted":False},{"_id":1},session=session):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Book not found")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Book is not borrowed by this member")
+    fine=loan["fine"]
+    if "overdue_ts" in loan:
+        effects.append(functools.partial(record_stats,overdue_increments(-1)))
+    book=await hand_off_copy(book_id,now,session,effects)
+    if book:
+        return book,fine
+    book=await books_collection.find_one_and_update(
+        {"_id":book_id},
+        [{"$set":{
+            "available_copies":{"$min":["$total_copies",{"$add":["$available_copies",1]}]},
+            "returned_ts":now,
+            "updated_ts":now
+        }},SET_STATUS_FROM_COPIES],
+        projection={"_id":1,"name":1,"available_copies":1,"status":1,"borrowed_by_name":1,"is_deleted":1},
+        return_document=ReturnDocument.AFTER,
+        session=session)
+    if book and not book.get("is_deleted"):
+        increments=copies_increments(-1)
+        if book["available_copies"]==1:
+            increments+=status_increments(BookStatus.borrowed.value,BookStatus.available.value)
+        effects.append(functools.partial(record_stats,increments))
+    return book or {"_id":book_id},fine
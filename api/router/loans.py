@@ -0,0 +1,70 @@
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Query
+from starlette import status
+from starlette.responses import Response
+
+from api.auth.authenticate import authenticate
+from api.database.connection import read_collection
+from api.database.overdue_sweeper import accrued_fine
+from api.model.loan import LoanStatus, overdue_loan_serializer
+from api.model.user import UserType
+from api.utils.serializer import json_response
+from api.utils.utils import get_timestamp
+
+loan_router = APIRouter(
+    tags=['Loans'],
+)
+OVERDUE_PAGE_SIZE = 50
+OVERDUE_MAX_PAGE_SIZE = 500
+overdue_reads = read_collection("loans", "get_overdue_loans")
+
+
+@loan_router.get("/loans/overdue")
+async def get_overdue_loans(limit: int = Query(OVERDUE_PAGE_SIZE, ge=1, le=OVERDUE_MAX_PAGE_SIZE),
+                            after: Optional[str] = None,
+                            user: object = Depends(authenticate)) -> Response:
+    """
+    This endpoint return the loans past their due date that are not returned yet, longest overdue first.
+    Pages are read in order of the status/due_ts index, so each one costs the same however deep it is.
+    :param limit (int): Maximum number of loans in the page.
+    :param after (str): Cursor returned as next_cursor by the previous page.
+    :param user:  An authenticated user object retrieved  through dependency injection.
+    :return (dict): A dict that contains list of overdue loans with their accrued fine and next_cursor
+    (None on the last page).
+    :raise HTTPException:
+    - 400 Bad request : If cursor is invalid
+    - 403 forbidden :   If user is member
+    """
+    if user.get("user_type") != UserType.librarian:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
+
+        )
+    now = get_timestamp()
+    query = {"status": LoanStatus.active, "due_ts": {"$lt": now}}
+    if after:
+        after_ts, _, after_id = after.partition(":")
+        if not after_ts.isdigit() or not ObjectId.is_valid(after_id):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor",
+
+            )
+        query["$or"] = [
+            {"due_ts": {"$gt": int(after_ts)}},
+            {"due_ts": int(after_ts), "_id": {"$gt": ObjectId(after_id)}}
+        ]
+    loans = await overdue_reads.find(query, overdue_loan_serializer.projection) \
+        .sort([("due_ts", 1), ("_id", 1)]).to_list(limit + 1)
+    next_cursor = None
+    if len(loans) > limit:
+        loans = loans[:limit]
+        next_cursor = f"{loans[-1]['due_ts']}:{loans[-1]['_id']}"
+    response = {
+        "loans": [{**overdue_loan_serializer(x), "fine": accrued_fine(x["due_ts"], now)} for x in loans],
+        "next_cursor": next_cursor
+    }
+    return json_response(response)
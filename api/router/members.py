@@ -1,15 +1,27 @@
+import logging
+from typing import Optional
+
 from bson import ObjectId
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, HTTPException, Query, Request
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
 from fastapi.encoders import jsonable_encoder
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
-from api.auth.authenticate import authenticate
+from api.auth.authenticate import authenticate, user_cache
 from api.auth.hash_password import HashPassword
-from api.database.connection import users_collection, books_collection
+from api.auth.token_revocation import revoke_tokens
+from api.database.catalogue_stats import record_stats, user_increments
+from api.database.connection import users_collection, holds_collection, read_collection, CACHE_FILL_READS
 from api.model.base import PyObjectId
-from api.model.book import Books
-from api.model.user import UserType, Users, UpdateMemberBody, AddUserModel
+from api.model.book_log import history_serializer
+from api.model.hold import HoldStatus
+from api.model.user import UserType, Users, UpdateMemberBody, AddUserModel, list_members_serializer
+from api.utils.response_cache import response_cache
+from api.utils.serializer import json_response, dump_json, raw_json_response
+from api.utils.upload import upload_format_of, iter_records, validation_messages, BulkReport
+from api.utils.utils import get_timestamp
 
 member_router = APIRouter(
     tags=['Members'],
@@ -19,11 +31,21 @@ member_router = APIRouter(
 )
 
 hash_password = HashPassword()
-
+logger = logging.getLogger(__name__)
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+BULK_BATCH_SIZE = 500
+BULK_MAX_BATCH_SIZE = 5000
+BULK_MAX_ERRORS = 1000
+members_list_reads = read_collection("users", "get_members_list")
+member_detail_reads = read_collection("users", "get_member_by_id")
+members_cache_fill_reads = read_collection("users", CACHE_FILL_READS)
+history_member_reads = read_collection("users", "get_history")
+history_reads = read_collection("book_logs", "get_history")
 
 
 @member_router.get("/members")
-async def get_members_list(user: object = Depends(authenticate)) -> dict:
+async def get_members_list(user: object = Depends(authenticate)) -> Response:
     """
     This endpoint will return list of members exist in system.
     :param user:  An authenticated user object retrieved  through dependency injection.
@@ -38,12 +60,17 @@ async def get_members_list(user: object = Depends(authenticate)) -> dict:
             detail="User not allowed to perform this action.",
 
         )
-    members = await users_collection.find({"user_type": UserType.member}).to_list(None)
-    members = [Users(**x).list_members() for x in members]
+    cached = await response_cache.lookup("members", "get_members_list")
+    if cached.body is not None:
+        return raw_json_response(cached.body)
+    reads = members_cache_fill_reads if cached.cacheable else members_list_reads
+    members = await reads.find({"user_type": UserType.member}, list_members_serializer.projection).to_list(None)
     response = {
-        "members": members
+        "members": [list_members_serializer(x) for x in members]
     }
-    return response
+    body = dump_json(response)
+    await response_cache.store(cached, body)
+    return raw_json_response(body)
 
 
 @member_router.post("/members")
@@ -71,7 +98,7 @@ async def create_member(user_request: AddUserModel, user: object = Depends(authe
             detail="username already exist",
 
         )
-    hash_p = hash_password.create_password_hash(user_request.password)
+    hash_p = await hash_password.create_password_hash_async(user_request.password)
     user_request.password = hash_p
     insert_user = {
         "username": user_request.username,
@@ -82,6 +109,8 @@ async def create_member(user_request: AddUserModel, user: object = Depends(authe
         "is_deleted": False
     }
     await users_collection.insert_one(insert_user)
+    await response_cache.invalidate("members")
+    await record_stats(user_increments(insert_user["user_type"], 1))
     response = {
         "message": "Member added successfully"
     }
@@ -89,6 +118,95 @@ async def create_member(user_request: AddUserModel, user: object = Depends(authe
                         content=response)
 
 
+@member_router.post("/members/bulk")
+async def bulk_create_members(request: Request,
+                              batch_size: int = Query(BULK_BATCH_SIZE, ge=1, le=BULK_MAX_BATCH_SIZE),
+                              user: object = Depends(authenticate)) -> JSONResponse:
+    """
+    This endpoint allow librarian to create many members from a streamed csv or ndjson upload.
+    Each batch checks username uniqueness with one query, hashes passwords in parallel and is inserted at once.
+    A csv upload needs a header row with username, password, user_type, address and email columns.
+    :param request (Request): The upload, with content type text/csv or application/x-ndjson.
+    :param batch_size (int): Number of members processed and written together.
+    :param user:  An authenticated user object retrieved  through dependency injection.
+    :return JSONResponse:  A JSON response that contains status code 200 and content which contains
+    number of inserted and failed rows and the errors of the failed rows.
+    :raise HTTPException:
+    - 403 forbidden :   If user is member
+    - 415 unsupported media type : If upload is neither csv nor ndjson
+    """
+    if user.get("user_type") != UserType.librarian:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
+
+        )
+    upload_format = upload_format_of(request)
+    report = BulkReport(BULK_MAX_ERRORS)
+    batch = []
+    processed = 0
+    async for row, record, error in iter_records(request, upload_format):
+        processed += 1
+        if error:
+            report.add_error(row, error)
+            continue
+        try:
+            batch.append((row, AddUserModel(**record)))
+        except ValidationError as validation_error:
+            report.add_error(row, validation_messages(validation_error))
+            continue
+        if len(batch) >= batch_size:
+            await _insert_members(batch, report)
+            batch = []
+            logger.info("Bulk member import: %s rows processed, %s inserted, %s failed",
+                        processed, report.inserted, report.failed)
+    if batch:
+        await _insert_members(batch, report)
+    logger.info("Bulk member import finished: %s rows processed, %s inserted, %s failed",
+                processed, report.inserted, report.failed)
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content=report.as_dict())
+
+
+async def _insert_members(batch: list, report: BulkReport):
+    usernames = [member.username for _, member in batch]
+    existing = await users_collection.find({"username": {"$in": usernames}, "is_deleted": False},
+                                           {"username": 1}).to_list(None)
+    taken = {x["username"] for x in existing}
+    accepted = []
+    for row, member in batch:
+        if member.username in taken:
+            report.add_error(row, "username already exist")
+            continue
+        taken.add(member.username)
+        accepted.append((row, member))
+    if not accepted:
+        return
+    hashes = await hash_password.create_password_hashes([member.password for _, member in accepted])
+    insert_users = [{
+        "username": member.username,
+        "password": hashed,
+        "user_type": member.user_type,
+        "address": member.address,
+        "email": member.email,
+        "is_deleted": False
+    } for (_, member), hashed in zip(accepted, hashes)]
+    failed = set()
+    try:
+        result = await users_collection.insert_many(insert_users, ordered=False)
+        report.inserted += len(result.inserted_ids)
+    except BulkWriteError as error:
+        report.inserted += error.details.get("nInserted", 0)
+        for write_error in error.details["writeErrors"]:
+            failed.add(write_error["index"])
+            report.add_error(accepted[write_error["index"]][0],
+                             "username already exist" if write_error.get("code") == 11000
+                             else write_error.get("errmsg", "Insert failed"))
+    await response_cache.invalidate("members")
+    await record_stats([x for index, inserted in enumerate(insert_users) if index not in failed
+                        for x in user_increments(inserted["user_type"], 1)])
+
+
 @member_router.put("/members/{member_id}")
 async def update_member(member_id: PyObjectId, user_request: UpdateMemberBody,
                         user: object = Depends(authenticate)) -> JSONResponse:
@@ -126,7 +244,15 @@ async def update_member(member_id: PyObjectId, user_request: UpdateMemberBody,
                 detail="username already exist",
 
             )
-    await users_collection.update_one({"_id": ObjectId(member_id)}, {"$set": user_request.__dict__})
+    if member.get("username") != user_request.username or member.get("user_type") != user_request.user_type:
+        # access tokens embed the username and user type, the ones issued before the change are revoked
+        await revoke_tokens(ObjectId(member_id), user_request.__dict__)
+        await record_stats(user_increments(member.get("user_type"), -1) + user_increments(user_request.user_type, 1))
+    else:
+        await users_collection.update_one({"_id": ObjectId(member_id)}, {"$set": user_request.__dict__})
+    user_cache.invalidate(member.get("username"))
+    user_cache.invalidate(user_request.username)
+    await response_cache.invalidate("members")
     response = {
         "message": "Member updated successfully"
     }
@@ -158,7 +284,12 @@ async def delete_member(member_id: PyObjectId, user: object = Depends(authentica
             detail="Member not found",
 
         )
-    await users_collection.update_one({"_id": ObjectId(member_id)}, {"$set": {"is_deleted": True}})
+    await revoke_tokens(ObjectId(member_id), {"is_deleted": True})
+    await holds_collection.update_many({"member_id": ObjectId(member_id), "status": HoldStatus.waiting},
+                                       {"$set": {"status": HoldStatus.cancelled, "cancelled_ts": get_timestamp()}})
+    user_cache.invalidate(member.get("username"))
+    await record_stats(user_increments(member.get("user_type"), -1))
+    await response_cache.invalidate("members")
     response = {
         "message": "Member deleted successfully"
     }
@@ -167,13 +298,23 @@ async def delete_member(member_id: PyObjectId, user: object = Depends(authentica
 
 
 @member_router.get("/members/{member_id}/history")
-async def get_history(member_id: PyObjectId, user: object = Depends(authenticate)) -> dict:
+async def get_history(member_id: PyObjectId,
+                      from_ts: Optional[int] = Query(None, ge=0),
+                      to_ts: Optional[int] = Query(None, ge=0),
+                      limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+                      before: Optional[str] = None,
+                      user: object = Depends(authenticate)) -> Response:
     """
-    This endpoint allow to get history of book borrowed and returned by specified member
+    This endpoint allow to get history of book borrowed and returned by specified member, newest first.
    :param member_id (PyObjectId): The unique identifier of the member.
+    :param from_ts (int): Only events at or after this timestamp in milliseconds.
+    :param to_ts (int): Only events at or before this timestamp in milliseconds.
+    :param limit (int): Maximum number of events in the page.
+    :param before (str): Cursor returned as next_cursor by the previous page.
     :param user:  An authenticated user object retrieved  through dependency injection.
-    :return (dict): A dict that contains list of books.
+    :return (dict): A dict that contains list of borrow and return events and next_cursor (None on the last page).
       :raise HTTPException:
+    - 400 Bad request : If cursor is invalid
     - 403 forbidden :   If user is member
     - 404 Not found : If member not found
     """
@@ -183,23 +324,48 @@ async def get_history(member_id: PyObjectId, user: object = Depends(authenticate
             detail="User not allowed to perform this action.",
 
         )
-    member = await users_collection.find_one({"_id": ObjectId(member_id), "is_deleted": False})
+    member = await history_member_reads.find_one({"_id": ObjectId(member_id), "is_deleted": False})
     if not member:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Member not found",
 
         )
-    books = await books_collection.find({"borrowed_by_id": ObjectId(member_id)}).to_list(None)
-    books = [Books(**x).list_books() for x in books]
+    query = {"member_id": ObjectId(member_id)}
+    ts_range = {}
+    if from_ts is not None:
+        ts_range["$gte"] = from_ts
+    if to_ts is not None:
+        ts_range["$lte"] = to_ts
+    if ts_range:
+        query["ts"] = ts_range
+    if before:
+        before_ts, _, before_id = before.partition(":")
+        if not before_ts.isdigit() or not ObjectId.is_valid(before_id):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor",
+
+            )
+        query["$or"] = [
+            {"ts": {"$lt": int(before_ts)}},
+            {"ts": int(before_ts), "_id": {"$lt": ObjectId(before_id)}}
+        ]
+    logs = await history_reads.find(query, history_serializer.projection) \
+        .sort([("ts", -1), ("_id", -1)]).to_list(limit + 1)
+    next_cursor = None
+    if len(logs) > limit:
+        logs = logs[:limit]
+        next_cursor = f"{logs[-1]['ts']}:{logs[-1]['_id']}"
     response = {
-        "books": books
+        "history": [history_serializer(x) for x in logs],
+        "next_cursor": next_cursor
     }
-    return response
+    return json_response(response)
 
 
 @member_router.get("/members/{member_id}")
-async def get_member_by_id(member_id: PyObjectId, user: object = Depends(authenticate)) -> dict:
+async def get_member_by_id(member_id: PyObjectId, user: object = Depends(authenticate)) -> Response:
     """
     This endpoint will return specified member by its id
    :param member_id (PyObjectId): The unique identifier of the member.
@@ -215,7 +381,11 @@ async def get_member_by_id(member_id: PyObjectId, user: object = Depends(authent
             detail="User not allowed to perform this action.",
 
         )
-    member = await users_collection.find_one({"_id": ObjectId(member_id), "is_deleted": False})
+    cached = await response_cache.lookup("members", "get_member_by_id", member_id)
+    if cached.body is not None:
+        return raw_json_response(cached.body)
+    reads = members_cache_fill_reads if cached.cacheable else member_detail_reads
+    member = await reads.find_one({"_id": ObjectId(member_id), "is_deleted": False})
     if not member:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Member not found")
@@ -223,7 +393,9 @@ async def get_member_by_id(member_id: PyObjectId, user: object = Depends(authent
     response = {
         "member": member_inst
     }
-    return response
+    body = dump_json(jsonable_encoder(response))
+    await response_cache.store(cached, body)
+    return raw_json_response(body)
 
 
 
@@ -0,0 +1,17 @@
+from fastapi import APIRouter
+from starlette.responses import PlainTextResponse
+
+from api.utils.metrics import registry
+
+metrics_router = APIRouter(
+    tags=['Metrics'],
+)
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def get_metrics() -> PlainTextResponse:
+    """
+    This endpoint expose request, MongoDB, cache and pool metrics in Prometheus text format.
+    :return PlainTextResponse: The current value of every registered metric.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,69 @@
+from fastapi import APIRouter, Depends, HTTPException
+from starlette import status
+from starlette.responses import Response
+
+from api.auth.authenticate import authenticate
+from api.database.catalogue_stats import STATUS, GENRE, AUTHOR, USERS, COPIES, LOANS, OVERDUE
+from api.database.connection import read_collection
+from api.model.book import BookStatus
+from api.model.user import UserType
+from api.utils.serializer import json_response
+
+stats_router = APIRouter(
+    tags=['Statistics'],
+)
+STATS_TOP_SIZE = 10
+stats_reads = read_collection("stats", "get_stats")
+stats_books_reads = read_collection("books", "get_stats")
+
+
+@stats_router.get("/stats")
+async def get_stats(user: object = Depends(authenticate)) -> Response:
+    """
+    This endpoint return catalogue statistics for the librarian dashboard.
+    Counts come from counters kept up to date by the write endpoints, so the cost doesn't grow with the catalogue.
+    :param user:  An authenticated user object retrieved  through dependency injection.
+    :return (dict): A dict that contains title counts by status, copy counts, the most common genres and authors,
+    number of active members, number of loans the overdue sweeper flagged and the most borrowed books.
+    :raise HTTPException:
+    - 403 forbidden :   If user is member
+    """
+    if user.get("user_type") != UserType.librarian:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User not allowed to perform this action.",
+
+        )
+    by_status = {x.value: 0 for x in BookStatus}
+    copies = {x.value: 0 for x in BookStatus}
+    async for counter in stats_reads.find({"dimension": {"$in": [STATUS, COPIES]}}):
+        (by_status if counter["dimension"] == STATUS else copies)[counter["value"]] = counter["count"]
+    users = await stats_reads.find_one({"dimension": USERS, "value": UserType.member.value})
+    overdue = await stats_reads.find_one({"dimension": LOANS, "value": OVERDUE})
+    top_borrowed = await stats_books_reads.find({"is_deleted": False, "borrow_count": {"$gt": 0}},
+                                                {"name": 1, "author": 1, "borrow_count": 1}) \
+        .sort("borrow_count", -1).limit(STATS_TOP_SIZE).to_list(STATS_TOP_SIZE)
+    response = {
+        "books": {
+            "total": sum(by_status.values()),
+            "by_status": by_status,
+            "copies": copies
+        },
+        "genres": await _top_counters(GENRE),
+        "authors": await _top_counters(AUTHOR),
+        "active_members": users["count"] if users else 0,
+        "overdue": overdue["count"] if overdue else 0,
+        "top_borrowed": [{
+            "id": str(x["_id"]),
+            "name": x.get("name"),
+            "author": x.get("author"),
+            "borrow_count": x["borrow_count"]
+        } for x in top_borrowed]
+    }
+    return json_response(response)
+
+
+async def _top_counters(dimension: str) -> list:
+    counters = await stats_reads.find({"dimension": dimension, "count": {"$gt": 0}}) \
+        .sort("count", -1).limit(STATS_TOP_SIZE).to_list(STATS_TOP_SIZE)
+    return [{"value": x["value"], "count": x["count"]} for x in counters]
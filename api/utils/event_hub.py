@@ -0,0 +1,124 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import AsyncIterator
+
+import orjson
+
+from api.database.connection import Settings
+from api.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+KEEPALIVE_FRAME = b": keepalive\n\n"
+# tells an evicted client that it missed events and should fetch the books again
+EVICTED_FRAME = b"event: evicted\ndata: {}\n\n"
+
+
+class HubFull(Exception):
+    pass
+
+
+class Subscriber:
+    """Server-sent event frames waiting to be sent to one client, at most buffer_size of them"""
+
+    def __init__(self, buffer_size: int):
+        self.buffer_size = buffer_size
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.evicted = False
+
+    def push(self, frame: bytes) -> bool:
+        if len(self.frames) >= self.buffer_size:
+            return False
+        self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    def close(self, evicted: bool = False):
+        self.closed = True
+        self.evicted = evicted
+        self.frames.clear()
+        self.ready.set()
+
+
+class EventHub:
+    """Fans events out to the clients connected to this worker. An event is encoded once and queued for every
+    client, a client whose buffer is full is evicted instead of slowing the others down or growing its buffer.
+    An idle client costs its empty buffer and a suspended task woken every keepalive seconds."""
+
+    def __init__(self, buffer_size: int, max_subscribers: int, keepalive: float):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.keepalive = keepalive
+        self.published = 0
+        self.evicted = 0
+        self._subscribers = set()
+        self._ids = itertools.count(1)
+
+    def subscribe(self) -> Subscriber:
+        if len(self._subscribers) >= self.max_subscribers:
+            raise HubFull(f"{len(self._subscribers)} clients are connected")
+        subscriber = Subscriber(self.buffer_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event: str, data: dict):
+        if not self._subscribers:
+            return
+        frame = b"id: %d\nevent: %s\ndata: %s\n\n" % (next(self._ids), event.encode(), orjson.dumps(data))
+        self.published += 1
+        slow = [subscriber for subscriber in self._subscribers if not subscriber.push(frame)]
+        for subscriber in slow:
+            self.evicted += 1
+            self.unsubscribe(subscriber)
+            subscriber.close(evicted=True)
+        if slow:
+            logger.warning("Evicted %s event clients that fell %s events behind", len(slow), self.buffer_size)
+
+    async def stream(self, subscriber: Subscriber) -> AsyncIterator[bytes]:
+        """Frames to send to subscriber until it is closed, the caller unsubscribes it when the client leaves"""
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.ready.wait(), timeout=self.keepalive)
+                except asyncio.TimeoutError:
+                    # also lets the server notice a client that went away
+                    yield KEEPALIVE_FRAME
+                    continue
+                subscriber.ready.clear()
+                if subscriber.frames:
+                    frames = b"".join(subscriber.frames)
+                    subscriber.frames.clear()
+                    yield frames
+                if subscriber.closed:
+                    if subscriber.evicted:
+                        yield EVICTED_FRAME
+                    return
+        finally:
+            self.unsubscribe(subscriber)
+
+    def close(self):
+        """Ends every stream. The server waits for open requests before the application shuts down, so streams
+        are only ended on shutdown by the server's graceful shutdown timeout, which cancels them."""
+        for subscriber in list(self._subscribers):
+            subscriber.close()
+        self._subscribers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._subscribers),
+            "published": self.published,
+            "evicted": self.evicted
+        }
+
+
+book_events = EventHub(setting.book_events_buffer_size, setting.book_events_max_clients,
+                       setting.book_events_keepalive)
+registry.gauges("book_events", "Book availability event stream", book_events.stats)
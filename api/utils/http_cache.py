@@ -0,0 +1,70 @@
+import hashlib
+import time
+from email.utils import formatdate
+from typing import Tuple
+
+from pymongo import ReturnDocument
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import Response
+
+from api.utils.utils import get_timestamp
+
+CACHE_CONTROL = "private, no-cache"
+
+
+class CatalogueVersion:
+    """Version counter of the book catalogue, kept in one document so every worker sees the same value.
+    Writes bump it. Reads trust the last value this worker saw for refresh_interval seconds, which is how
+    long a change made on another worker can take to invalidate ETags here."""
+
+    def __init__(self, collection, refresh_interval: float):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        self.modified_ts = 0
+        self._checked_at = None
+
+    def _remember(self, document: dict):
+        self.version = document.get("version", 0)
+        self.modified_ts = document.get("modified_ts", 0)
+        self._checked_at = time.monotonic()
+
+    async def current(self) -> Tuple[int, int]:
+        if self._checked_at is None or time.monotonic() - self._checked_at > self.refresh_interval:
+            self._remember(await self.collection.find_one({"_id": "catalogue"}) or {})
+        return self.version, self.modified_ts
+
+    async def bump(self):
+        document = await self.collection.find_one_and_update(
+            {"_id": "catalogue"},
+            {"$inc": {"version": 1}, "$max": {"modified_ts": get_timestamp()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        self._remember(document)
+
+
+def make_etag(version: int, *parts) -> str:
+    digest = hashlib.blake2b("\x1f".join(str(x) for x in parts).encode(), digest_size=8).hexdigest()
+    return f'"{version}-{digest}"'
+
+
+def cache_headers(etag: str, modified_ts: int) -> dict:
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if modified_ts:
+        headers["Last-Modified"] = formatdate(modified_ts / 1000, usegmt=True)
+    return headers
+
+
+def matches_if_none_match(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, a W/ prefix doesn't prevent a match
+    return etag in (x.strip().removeprefix("W/") for x in header.split(","))
+
+
+def not_modified_response(etag: str, modified_ts: int) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag, modified_ts))
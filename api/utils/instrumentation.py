@@ -0,0 +1,119 @@
+import contextvars
+import logging
+import time
+from typing import Optional
+
+from pymongo import monitoring
+
+from api.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests", ("method", "route", "status"))
+mongo_command_duration = registry.histogram(
+    "mongo_command_duration_seconds", "Time spent in MongoDB commands", ("collection", "command"))
+mongo_command_failures = registry.counter(
+    "mongo_command_failures_total", "MongoDB commands that failed", ("collection", "command"))
+phase_duration = registry.histogram(
+    "app_phase_duration_seconds", "Time spent in instrumented phases of request handling", ("phase",))
+
+
+class RequestStats:
+    """Mongo commands and phases attributed to one request"""
+
+    def __init__(self):
+        self.commands = {}
+        self.phases = {}
+
+    def add_command(self, collection: str, command: str, seconds: float):
+        totals = self.commands.setdefault(f"{collection}.{command}", [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def add_phase(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def breakdown(self) -> dict:
+        return {
+            "mongo": {name: {"count": count, "ms": round(seconds * 1000, 3)}
+                      for name, (count, seconds) in self.commands.items()},
+            "phases_ms": {phase: round(seconds * 1000, 3) for phase, seconds in self.phases.items()}
+        }
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request", default=None)
+
+
+def record_phase(phase: str, seconds: float):
+    phase_duration.observe(seconds, phase=phase)
+    stats = current_request.get()
+    if stats is not None:
+        stats.add_phase(phase, seconds)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Counts and times every command per collection and attributes it to the request that issued it.
+    Motor runs commands on its executor with a copy of the caller's context, so current_request is visible here."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "")
+        self._pending[(event.connection_id, event.request_id)] = (collection, current_request.get())
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finish(event, failed=True)
+
+    def _finish(self, event, failed: bool):
+        collection, stats = self._pending.pop((event.connection_id, event.request_id), ("", None))
+        seconds = event.duration_micros / 1_000_000
+        mongo_command_duration.observe(seconds, collection=collection, command=event.command_name)
+        if failed:
+            mongo_command_failures.inc(collection=collection, command=event.command_name)
+        if stats is not None:
+            stats.add_command(collection, event.command_name, seconds)
+
+
+command_listener = MongoCommandListener()
+
+
+class MetricsMiddleware:
+    """Records latency per route template and logs the query breakdown of requests slower than slow_request_ms"""
+
+    def __init__(self, app, slow_request_ms: float = 0):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_duration.observe(elapsed, method=scope["method"], route=route, status=str(status_code))
+            if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+                logger.warning("Slow request %s %s %s took %.1f ms: %s", scope["method"], route, status_code,
+                               elapsed * 1000, stats.breakdown())
+            current_request.reset(token)
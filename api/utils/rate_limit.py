@@ -0,0 +1,222 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs
+
+import orjson
+from starlette import status
+from starlette.responses import JSONResponse
+
+from api.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+rate_limited_requests = registry.counter(
+    "rate_limited_requests_total", "Requests rejected by the rate limiter", ("route", "scope"))
+
+SCOPE_IP = "ip"
+SCOPE_USERNAME = "username"
+# a login body is a few hundred bytes, a larger one is replayed to the app without being read for its username
+MAX_USERNAME_BODY_BYTES = 16 * 1024
+
+
+class RateLimitRule(NamedTuple):
+    scope: str
+    limit: int
+    window: float
+
+
+def parse_rules(spec: str) -> List[RateLimitRule]:
+    """Parses rules written as scope:limit/seconds separated by commas, e.g. ip:20/60,username:10/300"""
+    rules = []
+    for rule in spec.split(","):
+        scope, _, rate = rule.strip().partition(":")
+        limit, _, window = rate.partition("/")
+        if scope not in (SCOPE_IP, SCOPE_USERNAME) or not limit.isdigit():
+            raise ValueError(f"Invalid rate limit rule {rule!r}")
+        rules.append(RateLimitRule(scope, int(limit), float(window or 1)))
+    return rules
+
+
+def _retry_after(previous: int, current: int, elapsed: float, window: float, limit: int) -> float:
+    """Seconds until the sliding window estimate leaves room for one more request"""
+    excess = previous * (window - elapsed) / window + current + 1 - limit
+    if previous and excess <= previous * (window - elapsed) / window:
+        return max(excess * window / previous, 0.001)
+    # the current window becomes the previous one, whose weight has to decay far enough as well
+    wait = window - elapsed
+    if current:
+        wait += max(0.0, window * (1 - (limit - 1) / current))
+    return max(wait, 0.001)
+
+
+class MemoryRateLimitBackend:
+    """Sliding window counters of this process, each key keeps the counts of its current and previous window.
+    The request rate is estimated as the previous count weighted by how much of it still overlaps plus the current one."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._windows: OrderedDict = OrderedDict()
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        now = time.time()
+        index = int(now // window)
+        elapsed = now - index * window
+        entry = self._windows.get(key)
+        if entry is None or entry[0] < index - 1:
+            previous, current = 0, 0
+        elif entry[0] == index - 1:
+            previous, current = entry[2], 0
+        else:
+            previous, current = entry[1], entry[2]
+        if previous * (window - elapsed) / window + current + 1 > limit:
+            return _retry_after(previous, current, elapsed, window, limit)
+        self._windows[key] = (index, previous, current + 1)
+        self._windows.move_to_end(key)
+        while len(self._windows) > self.max_keys:
+            self._windows.popitem(last=False)
+        return 0
+
+    async def close(self):
+        self._windows.clear()
+
+
+class RedisRateLimitBackend:
+    """Sliding window counters shared by every worker in a Redis compatible server, one key per window.
+    A client can be passed in, e.g. a fakeredis one."""
+
+    def __init__(self, url: Optional[str], prefix: str = "lms:ratelimit:", client=None):
+        if client is None:
+            try:
+                import redis.asyncio
+            except ImportError:
+                raise RuntimeError("rate_limit_backend redis needs the redis package installed")
+            client = redis.asyncio.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        now = time.time()
+        index = int(now // window)
+        elapsed = now - index * window
+        current_key = f"{self.prefix}{key}:{index}"
+        # counting first and taking the request back when over the limit keeps concurrent workers from overshooting
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.incr(current_key)
+            pipe.pexpire(current_key, int(window * 2000))
+            pipe.get(f"{self.prefix}{key}:{index - 1}")
+            current, _, previous = await pipe.execute()
+        previous = int(previous or 0)
+        if previous * (window - elapsed) / window + current > limit:
+            await self.client.decr(current_key)
+            return _retry_after(previous, current - 1, elapsed, window, limit)
+        return 0
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def _username_of(body: bytes, content_type: str) -> Optional[str]:
+    try:
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            username = parse_qs(body.decode("latin-1")).get("username", [None])[0]
+        elif content_type.startswith("application/json"):
+            username = orjson.loads(body).get("username")
+        else:
+            return None
+    except (ValueError, AttributeError):
+        return None
+    return username if isinstance(username, str) and username else None
+
+
+class RateLimitMiddleware:
+    """Rejects requests over the limits of their route with 429 before the app sees them.
+    routes maps "METHOD /path" to its rules. A username rule reads the form or json body, at most
+    MAX_USERNAME_BODY_BYTES of it, which is then replayed to the app."""
+
+    def __init__(self, app, backend, routes: Dict[str, List[RateLimitRule]], trust_forwarded: bool = False):
+        self.app = app
+        self.backend = backend
+        self.routes = routes
+        self.trust_forwarded = trust_forwarded
+
+    def _client_ip(self, scope) -> str:
+        if self.trust_forwarded:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    # the proxy in front of the app appends the address it saw last
+                    return value.decode("latin-1").split(",")[-1].strip()
+        client = scope.get("client")
+        return client[0] if client else ""
+
+    async def _reject(self, route: str, rule: RateLimitRule, key: str, scope, receive, send) -> bool:
+        """Counts the request against rule and answers it with 429 when that puts it over the limit"""
+        try:
+            retry_after = await self.backend.hit(key, rule.limit, rule.window)
+        except Exception as error:
+            # an unreachable backend lets requests through rather than locking every user out
+            logger.warning("Rate limit check failed for %s: %s", route, error)
+            return False
+        if not retry_after:
+            return False
+        rate_limited_requests.inc(route=route, scope=rule.scope)
+        response = JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                content={"detail": "Too many requests"},
+                                headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+        await response(scope, receive, send)
+        return True
+
+    async def __call__(self, scope, receive, send):
+        route = f"{scope.get('method')} {scope.get('path')}"
+        rules = self.routes.get(route) if scope["type"] == "http" and self.backend is not None else None
+        if not rules:
+            await self.app(scope, receive, send)
+            return
+        # the ip rules come first, a client over them is rejected before its body is read
+        for rule in rules:
+            if rule.scope == SCOPE_IP and \
+                    await self._reject(route, rule, f"{route}:ip:{self._client_ip(scope)}", scope, receive, send):
+                return
+        username_rules = [rule for rule in rules if rule.scope == SCOPE_USERNAME]
+        if username_rules:
+            username, receive = await self._read_username(scope, receive)
+            if username is not None:
+                for rule in username_rules:
+                    if await self._reject(route, rule, f"{route}:username:{username}", scope, receive, send):
+                        return
+        await self.app(scope, receive, send)
+
+    async def _read_username(self, scope, receive) -> tuple:
+        """Reads the username of the body, up to MAX_USERNAME_BODY_BYTES of it, and returns it with a receive
+        that replays the messages read to the app"""
+        messages = []
+        size = 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            size += len(message.get("body", b""))
+            complete = message["type"] != "http.request" or not message.get("more_body")
+            if complete or size > MAX_USERNAME_BODY_BYTES:
+                break
+        username = None
+        if complete and size <= MAX_USERNAME_BODY_BYTES:
+            content_type = next((value.decode("latin-1") for name, value in scope["headers"]
+                                 if name == b"content-type"), "")
+            username = _username_of(b"".join(x.get("body", b"") for x in messages), content_type)
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        return username, replay
+
+
+def create_backend(name: str, url: Optional[str], max_keys: int):
+    if name == "memory":
+        return MemoryRateLimitBackend(max_keys)
+    if name == "redis":
+        return RedisRateLimitBackend(url)
+    return None
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from api.database.connection import Settings, books_collection, users_collection
+from api.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+setting = Settings()
+
+cache_requests = registry.counter(
+    "response_cache_requests_total", "Response cache lookups per route", ("route", "result"))
+
+# collection whose changes invalidate a namespace of cached responses
+NAMESPACE_COLLECTIONS = {
+    "books": books_collection,
+    "members": users_collection,
+}
+# change streams need a replica set or a sharded cluster, a standalone server answers with this code
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+
+class MemoryCacheBackend:
+    """Bounded LRU in this process. Writes on other workers only reach it through the change stream watcher."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._generations: Dict[str, int] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() > expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def generation(self, namespace: str) -> int:
+        return self._generations.get(namespace, 0)
+
+    async def bump(self, namespace: str):
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    async def close(self):
+        self._entries.clear()
+
+
+class RedisCacheBackend:
+    """Cache shared by every worker in a Redis compatible server. A client can be passed in, e.g. a fakeredis one."""
+
+    def __init__(self, url: Optional[str], prefix: str = "lms:cache:", client=None):
+        if client is None:
+            try:
+                import redis.asyncio
+            except ImportError:
+                raise RuntimeError("response_cache_backend redis needs the redis package installed")
+            client = redis.asyncio.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.client.set(self.prefix + key, value, px=max(int(ttl * 1000), 1))
+
+    async def generation(self, namespace: str) -> int:
+        return int(await self.client.get(f"{self.prefix}generation:{namespace}") or 0)
+
+    async def bump(self, namespace: str):
+        await self.client.incr(f"{self.prefix}generation:{namespace}")
+
+    def size(self) -> int:
+        return -1
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class CacheLookup(NamedTuple):
+    route: str
+    key: Optional[str]
+    body: Optional[bytes]
+
+    @property
+    def cacheable(self) -> bool:
+        """A response that gets cached has to be read from the primary, a lagging secondary would have its stale
+        body cached under the current generation"""
+        return self.key is not None
+
+
+class ResponseCache:
+    """Serialized responses keyed by route, request parameters and the generation of their namespace.
+    Invalidating a namespace bumps its generation, so older entries are never read again and expire on their own.
+    A backend error is logged and treated as a miss, the cache never fails a request."""
+
+    def __init__(self, backend, default_ttl: float, ttls: Dict[str, float]):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def ttl_of(self, route: str) -> float:
+        return self.ttls.get(route, self.default_ttl)
+
+    async def lookup(self, namespace: str, route: str, *parts) -> CacheLookup:
+        if self.backend is None or self.ttl_of(route) <= 0:
+            return CacheLookup(route, None, None)
+        digest = hashlib.blake2b("\x1f".join(str(x) for x in parts).encode(), digest_size=16).hexdigest()
+        try:
+            key = f"{namespace}:{await self.backend.generation(namespace)}:{route}:{digest}"
+            body = await self.backend.get(key)
+        except Exception as error:
+            logger.warning("Response cache lookup failed for %s: %s", route, error)
+            return CacheLookup(route, None, None)
+        if body is None:
+            self.misses += 1
+            cache_requests.inc(route=route, result="miss")
+        else:
+            self.hits += 1
+            cache_requests.inc(route=route, result="hit")
+        return CacheLookup(route, key, body)
+
+    async def store(self, lookup: CacheLookup, body: bytes):
+        if lookup.key is None:
+            return
+        try:
+            await self.backend.set(lookup.key, body, self.ttl_of(lookup.route))
+        except Exception as error:
+            logger.warning("Response cache store failed for %s: %s", lookup.route, error)
+
+    async def invalidate(self, namespace: str):
+        if self.backend is None:
+            return
+        self.invalidations += 1
+        try:
+            await self.backend.bump(namespace)
+        except Exception as error:
+            logger.error("Response cache invalidation of %s failed: %s", namespace, error)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+        if self.backend is not None and self.backend.size() >= 0:
+            stats["entries"] = self.backend.size()
+        return stats
+
+
+class ChangeStreamInvalidator:
+    """Invalidates a namespace whenever its collection changes, whichever worker or script made the change"""
+
+    def __init__(self, cache: ResponseCache, collections: dict):
+        self.cache = cache
+        self.collections = collections
+        self._tasks = []
+
+    async def _watch(self, namespace: str, collection):
+        resume_after = None
+        while True:
+            try:
+                async with collection.watch(resume_after=resume_after) as stream:
+                    if resume_after is None:
+                        # changes made before the stream opened were not seen
+                        await self.cache.invalidate(namespace)
+                    async for _ in stream:
+                        resume_after = stream.resume_token
+                        await self.cache.invalidate(namespace)
+            except OperationFailure as error:
+                if error.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.error("Change streams are not supported by this deployment, "
+                                 "cached %s responses are only invalidated by writes on this worker", namespace)
+                    return
+                logger.warning("Change stream on %s failed, reopening: %s", namespace, error)
+                resume_after = None
+                await asyncio.sleep(1)
+            except PyMongoError as error:
+                logger.warning("Change stream on %s interrupted, resuming: %s", namespace, error)
+                await asyncio.sleep(1)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._watch(namespace, collection))
+                           for namespace, collection in self.collections.items()]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+def create_backend():
+    if setting.response_cache_backend == "memory":
+        return MemoryCacheBackend(setting.response_cache_max_entries)
+    if setting.response_cache_backend == "redis":
+        return RedisCacheBackend(setting.response_cache_url)
+    return None
+
+
+response_cache = ResponseCache(create_backend(), setting.response_cache_ttl, setting.response_cache_ttls)
+response_cache_invalidator = ChangeStreamInvalidator(response_cache, NAMESPACE_COLLECTIONS)
+registry.gauges("response_cache", "Response cache", response_cache.stats)
+
+
+def start_response_cache():
+    if response_cache.backend is not None and setting.response_cache_change_stream:
+        response_cache_invalidator.start()
+
+
+async def stop_response_cache():
+    await response_cache_invalidator.stop()
+    if response_cache.backend is not None:
+        await response_cache.backend.close()
@@ -0,0 +1,42 @@
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+import orjson
+from starlette import status
+from starlette.responses import Response
+
+Field = Tuple[str, str, Any, Optional[Callable[[Any], Any]]]
+
+
+class DocumentSerializer:
+    """Maps raw Mongo documents to response dicts without building a pydantic model per document.
+    Each field is (output key, document field, default when missing, converter or None)."""
+
+    def __init__(self, fields: Iterable[Field]):
+        self.fields = tuple(fields)
+        self.projection = {source: 1 for _, source, _, _ in self.fields if source != "_id"}
+
+    def __call__(self, document: dict) -> dict:
+        output = {}
+        for key, source, default, converter in self.fields:
+            value = document.get(source, default)
+            output[key] = converter(value) if converter else value
+        return output
+
+
+def normalized_email(value: str) -> str:
+    """Same normalisation pydantic's EmailStr applies, the domain part is lower cased"""
+    local_part, at, domain = value.strip().rpartition("@")
+    return local_part + at + domain.lower() if at else value
+
+
+def dump_json(content: Any) -> bytes:
+    return orjson.dumps(content)
+
+
+def json_response(content: Any, status_code: int = status.HTTP_200_OK, headers: Optional[dict] = None) -> Response:
+    """Byte for byte the body JSONResponse renders, encoded with orjson"""
+    return raw_json_response(orjson.dumps(content), status_code, headers)
+
+
+def raw_json_response(body: bytes, status_code: int = status.HTTP_200_OK, headers: Optional[dict] = None) -> Response:
+    return Response(content=body, status_code=status_code, headers=headers, media_type="application/json")
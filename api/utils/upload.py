@@ -0,0 +1,146 @@
+import csv
+import json
+from enum import Enum
+from typing import AsyncIterator, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from starlette import status
+
+
+class UploadFormat(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+CONTENT_TYPES = {
+    "text/csv": UploadFormat.csv,
+    "application/csv": UploadFormat.csv,
+    "application/x-ndjson": UploadFormat.ndjson,
+    "application/ndjson": UploadFormat.ndjson,
+    "application/jsonl": UploadFormat.ndjson,
+}
+# longest line, and longest csv record spanning several lines, kept in memory
+MAX_LINE_BYTES = 64 * 1024
+MAX_RECORD_BYTES = 256 * 1024
+
+
+def upload_format_of(request: Request) -> UploadFormat:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in CONTENT_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Upload must be text/csv or application/x-ndjson",
+        )
+    return CONTENT_TYPES[content_type]
+
+
+async def _iter_lines(request: Request) -> AsyncIterator[Optional[str]]:
+    """Lines of the body as they arrive. A line longer than MAX_LINE_BYTES is dropped while it is received
+    instead of being buffered, and yielded as None once it ends."""
+    pending = b""
+    first = True
+    skipping = False
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if first:
+                line = line.removeprefix(b"\xef\xbb\xbf")
+                first = False
+            if skipping or len(line) > MAX_LINE_BYTES:
+                skipping = False
+                yield None
+                continue
+            yield line.rstrip(b"\r").decode("utf-8", errors="replace")
+        if len(pending) > MAX_LINE_BYTES:
+            pending = b""
+            first = False
+            skipping = True
+    if skipping:
+        yield None
+    elif pending:
+        if first:
+            pending = pending.removeprefix(b"\xef\xbb\xbf")
+        yield pending.rstrip(b"\r").decode("utf-8", errors="replace")
+
+
+async def iter_records(request: Request, upload_format: UploadFormat) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    """Yield (row number, record, error) for every row of the uploaded body while it is being received.
+    Row numbers start at 1 and don't count the csv header, only one of record and error is set."""
+    row = 0
+    header = None
+    record_lines = []
+    record_size = 0
+    async for line in _iter_lines(request):
+        if line is None:
+            # the rows that follow an oversized csv record that was still open may not line up
+            record_lines, record_size = [], 0
+            row += 1
+            yield row, None, f"Row is longer than {MAX_LINE_BYTES} bytes"
+            continue
+        if upload_format == UploadFormat.ndjson:
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                record = json.loads(line)
+            except ValueError as error:
+                yield row, None, f"Invalid JSON: {error}"
+                continue
+            if not isinstance(record, dict):
+                yield row, None, "Row must be a JSON object"
+                continue
+            yield row, record, None
+            continue
+        record_lines.append(line)
+        record_size += len(line)
+        # a quoted csv field may contain line breaks, keep reading until the quotes are balanced
+        if sum(x.count('"') for x in record_lines) % 2:
+            if record_size > MAX_RECORD_BYTES:
+                # most likely a stray quote, which would otherwise hold the rest of the upload in memory
+                record_lines, record_size = [], 0
+                row += 1
+                yield row, None, f"Quoted field is longer than {MAX_RECORD_BYTES} bytes"
+            continue
+        values = next(csv.reader(["\n".join(record_lines)]), [])
+        record_lines, record_size = [], 0
+        if not any(value.strip() for value in values):
+            continue
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        yield row, dict(zip(header, values)), None
+    if record_lines:
+        yield row + 1, None, "Unterminated quoted field"
+
+
+def validation_messages(error: ValidationError) -> list:
+    return [{"field": ".".join(str(x) for x in item["loc"]), "message": item["msg"]} for item in error.errors()]
+
+
+class BulkReport:
+    """Counts the outcome of a bulk upload and keeps the first max_errors row errors"""
+
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, row: int, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row, "errors": errors if isinstance(errors, list) else [{"message": errors}]})
+
+    def as_dict(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors)
+        }
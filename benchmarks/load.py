@@ -0,0 +1,221 @@
+"""
+Load benchmark for the router endpoints.
+
+`run` seeds a dedicated MongoDB database with a catalogue and members, drives the FastAPI app in process
+at each concurrency level and writes throughput and p50/p95/p99 latency per endpoint as JSON.
+`compare` reads two reports and lists the endpoints whose p95 latency or throughput regressed beyond the
+threshold, exiting with status 1 if there is any.
+
+    python -m benchmarks.load run --books 100000 --members 2000 --concurrency 1,16,64 --output base.json
+    python -m benchmarks.load compare base.json new.json --threshold 0.1
+
+The seeded database is dropped first, so it must not be the one the API is configured with.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+BENCH_PASSWORD = "Bench#pass1"
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def seed(db, books: int, members: int, password_hash: str) -> dict:
+    from api.utils.utils import get_timestamp
+
+    await db.client.drop_database(db.name)
+    librarian = await db["users"].insert_one({
+        "username": "bench-librarian", "password": password_hash, "user_type": "librarian",
+        "address": "bench", "email": "librarian@example.com", "is_deleted": False
+    })
+    member_ids = []
+    for start in range(0, members, 1000):
+        result = await db["users"].insert_many([{
+            "username": f"bench-member-{i}", "password": password_hash, "user_type": "member",
+            "address": "bench", "email": f"member{i}@example.com", "is_deleted": False
+        } for i in range(start, min(start + 1000, members))])
+        member_ids += result.inserted_ids
+    book_ids = []
+    now = get_timestamp()
+    for start in range(0, books, 5000):
+        result = await db["books"].insert_many([{
+            "name": f"Bench book {i}", "description": f"Description of bench book {i}", "created_ts": now,
+            "author": f"Author {i % 1000}", "genre": ["Fiction", "Action", "History", "Science"][i % 4],
+            "is_deleted": False
+        } for i in range(start, min(start + 5000, books))])
+        book_ids += result.inserted_ids
+    return {"librarian_id": librarian.inserted_id, "member_ids": member_ids, "book_ids": book_ids}
+
+
+async def drive(client, name: str, concurrency: int, requests: int, make_request) -> dict:
+    latencies = []
+    errors = 0
+    issued = 0
+
+    async def worker(worker_id: int):
+        nonlocal issued, errors
+        while issued < requests:
+            sequence = issued
+            issued += 1
+            started = time.perf_counter()
+            response = await make_request(client, worker_id, sequence)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "endpoint": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3)
+    }
+
+
+async def login(client, username: str) -> dict:
+    response = await client.post("/login", data={"username": username, "password": BENCH_PASSWORD})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def run(args) -> dict:
+    os.environ["database_url"] = args.mongo_url
+    os.environ["database_name"] = args.database
+    os.environ.setdefault("secret_key", "benchmark-secret")
+    os.environ.setdefault("algorithm", "HS256")
+    # every request comes from one client address, the login limits would answer most of them with 429
+    os.environ.setdefault("rate_limit_backend", "none")
+    import httpx
+    from api.auth.hash_password import HashPassword
+    from api.database.connection import get_database
+    from api.main import app
+
+    concurrency_levels = [int(x) for x in args.concurrency.split(",")]
+    members = max(args.members, max(concurrency_levels))
+    books = max(args.books, max(concurrency_levels))
+    seeded = await seed(get_database(), books, members, HashPassword().create_password_hash(BENCH_PASSWORD))
+    book_ids = [str(x) for x in seeded["book_ids"]]
+    history_member = str(seeded["member_ids"][0])
+
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            librarian = await login(client, "bench-librarian")
+            member_headers = [await login(client, f"bench-member-{i}") for i in range(max(concurrency_levels))]
+
+            borrow_rounds = [0] * max(concurrency_levels)
+
+            async def borrow_return(c, worker_id, sequence):
+                # every worker alternates borrow and return on its own book, so they never race each other
+                borrow = "true" if borrow_rounds[worker_id] % 2 == 0 else "false"
+                borrow_rounds[worker_id] += 1
+                return await c.post(f"/books/{book_ids[worker_id]}/borrow-return/{borrow}",
+                                    headers=member_headers[worker_id])
+
+            scenarios = {
+                "POST /login": lambda c, w, s: c.post("/login", data={"username": f"bench-member-{w}",
+                                                                      "password": BENCH_PASSWORD}),
+                "GET /books": lambda c, w, s: c.get("/books", params={"limit": args.page_size}, headers=librarian),
+                "GET /books/{book_id}": lambda c, w, s: c.get(f"/books/{book_ids[s % len(book_ids)]}",
+                                                             headers=librarian),
+                "GET /books/search": lambda c, w, s: c.get("/books/search", params={"q": f"Author {s % 1000}"},
+                                                          headers=librarian),
+                "GET /members": lambda c, w, s: c.get("/members", headers=librarian),
+                "GET /members/{member_id}/history": lambda c, w, s: c.get(f"/members/{history_member}/history",
+                                                                         headers=librarian),
+                "POST /books/{book_id}/borrow-return": borrow_return,
+            }
+            selected = args.endpoints.split(",") if args.endpoints else list(scenarios)
+            for name in selected:
+                for concurrency in concurrency_levels:
+                    result = await drive(client, name, concurrency, args.requests, scenarios[name])
+                    results.append(result)
+                    print(json.dumps(result), file=sys.stderr)
+    return {
+        "meta": {
+            "books": books,
+            "members": members,
+            "requests": args.requests,
+            "concurrency": concurrency_levels,
+            "page_size": args.page_size,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": results
+    }
+
+
+def compare(base: dict, current: dict, threshold: float) -> list:
+    baseline = {(x["endpoint"], x["concurrency"]): x for x in base["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline.get((result["endpoint"], result["concurrency"]))
+        if not previous:
+            continue
+        p95_change = (result["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] if previous["p95_ms"] else 0
+        throughput_change = ((previous["throughput_rps"] - result["throughput_rps"]) / previous["throughput_rps"]
+                             if previous["throughput_rps"] else 0)
+        if p95_change > threshold or throughput_change > threshold:
+            regressions.append({
+                "endpoint": result["endpoint"],
+                "concurrency": result["concurrency"],
+                "p95_ms": [previous["p95_ms"], result["p95_ms"]],
+                "throughput_rps": [previous["throughput_rps"], result["throughput_rps"]]
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    run_parser.add_argument("--database", default="library_benchmark")
+    run_parser.add_argument("--books", type=int, default=10000)
+    run_parser.add_argument("--members", type=int, default=500)
+    run_parser.add_argument("--concurrency", default="1,8,32")
+    run_parser.add_argument("--requests", type=int, default=500, help="requests per endpoint and concurrency level")
+    run_parser.add_argument("--page-size", type=int, default=100)
+    run_parser.add_argument("--endpoints", help="comma separated subset of the endpoint names")
+    run_parser.add_argument("--output", help="write the report here instead of stdout")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="allowed relative p95 increase or throughput decrease")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.base) as base, open(args.current) as current:
+            regressions = compare(json.load(base), json.load(current), args.threshold)
+        print(json.dumps({"regressions": regressions}, indent=2))
+        sys.exit(1 if regressions else 0)
+
+    if args.database == os.getenv("database_name"):
+        sys.exit("Refusing to seed the database the API is configured with, pass another --database")
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
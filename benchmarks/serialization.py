@@ -0,0 +1,101 @@
+"""
+Micro-benchmark of the list endpoint serialization paths.
+
+Compares building a pydantic model per document and rendering it through jsonable_encoder/JSONResponse,
+which is what the list endpoints used to do, with the precompiled DocumentSerializer maps rendered by orjson.
+Both paths must produce the same bytes, the script fails otherwise.
+
+    python -m benchmarks.serialization --rows 10000 --repeat 5
+"""
+import argparse
+import json
+import time
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from api.model.book import Books, BookStatus, list_books_serializer
+from api.model.user import Users, list_members_serializer
+from api.utils.serializer import json_response
+
+
+def book_documents(rows: int) -> list:
+    documents = []
+    for i in range(rows):
+        document = {
+            "_id": ObjectId(),
+            "name": f"Book {i} – édition",
+            "description": "Fiction books",
+            "created_ts": 1728398846515 + i,
+            "author": f"Author {i % 500}",
+            "genre": ["Fiction", "Action", "History"][i % 3],
+            "is_deleted": False
+        }
+        if i % 2:
+            document.update({
+                "borrowed_by_id": ObjectId(),
+                "borrowed_by_name": f"member{i}",
+                "borrowed_ts": 1728399021440 + i,
+                "returned_ts": 0,
+                "status": BookStatus.borrowed.value
+            })
+        documents.append(document)
+    return documents
+
+
+def member_documents(rows: int) -> list:
+    return [{
+        "_id": ObjectId(),
+        "username": f"member{i}",
+        "password": "$2b$12$g/262V.62amh3F5EZgFqH.moNVi4blmBKByDO96gIrljOo0GlgeG.",
+        "user_type": "member",
+        "address": "street sd",
+        "email": f"member{i}@example.com",
+        "is_deleted": i % 10 == 0
+    } for i in range(rows)]
+
+
+def best_of(repeat: int, func) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def compare(name: str, repeat: int, model_path, serializer_path) -> dict:
+    if model_path() != serializer_path():
+        raise SystemExit(f"{name}: serializer output differs from the model output")
+    model_seconds = best_of(repeat, model_path)
+    serializer_seconds = best_of(repeat, serializer_path)
+    return {
+        "endpoint": name,
+        "model_seconds": round(model_seconds, 6),
+        "serializer_seconds": round(serializer_seconds, 6),
+        "speedup": round(model_seconds / serializer_seconds, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    books = book_documents(args.rows)
+    members = member_documents(args.rows)
+    results = [
+        compare("books", args.repeat,
+                lambda: JSONResponse(content=jsonable_encoder({"books": [Books(**x).list_books() for x in books]})).body,
+                lambda: json_response({"books": [list_books_serializer(x) for x in books]}).body),
+        compare("members", args.repeat,
+                lambda: JSONResponse(content=jsonable_encoder(
+                    {"members": [Users(**x).list_members() for x in members]})).body,
+                lambda: json_response({"members": [list_members_serializer(x) for x in members]}).body),
+    ]
+    print(json.dumps({"rows": args.rows, "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("database_url", "mongodb://localhost:27017")
+os.environ.setdefault("database_name", "library_test")
+os.environ.setdefault("secret_key", "test-secret")
+os.environ.setdefault("algorithm", "HS256")
+# mongomock runs neither transactions nor the hello command that detects them
+os.environ.setdefault("mongo_transactions", "false")
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """A mongomock database standing in for MongoDB, used by every collection of the app"""
+    from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockCollection
+
+    from api.auth.authenticate import user_cache
+    from api.database import connection
+
+    client = AsyncMongoMockClient()
+    # mongomock has no read preferences, the secondary read handles get the collection itself
+    monkeypatch.setattr(AsyncMongoMockCollection, "with_options", lambda self, **options: self, raising=False)
+    monkeypatch.setattr(connection, "client", client)
+    # users authenticated by an earlier test are not in this database
+    user_cache.clear()
+    return client[connection.setting.database_name]
+
+
+@pytest.fixture
+def client(database):
+    """Client of the app for the requests of a test, to be used inside asyncio.run"""
+    import httpx
+
+    from api.main import app
+
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+    yield client
+    asyncio.run(client.aclose())
+
+
+@pytest.fixture
+def add_user(database):
+    """add_user(user_type, username) stores a user and returns it"""
+    def add(user_type: str, username: str) -> dict:
+        from bson import ObjectId
+
+        user = {"_id": ObjectId(), "username": username, "password": "", "user_type": user_type,
+                "address": "a", "email": f"{username}@example.com", "is_deleted": False}
+        asyncio.run(database.users.insert_one(user))
+        return user
+    return add
+
+
+@pytest.fixture
+def librarian(add_user):
+    return add_user("librarian", "librarian")
+
+
+@pytest.fixture
+def member(add_user):
+    return add_user("member", "member")
+
+
+@pytest.fixture
+def auth_headers():
+    """auth_headers(user) are the headers of a request made with an access token of user"""
+    from api.auth.jwt_handler import create_access_token, token_claims
+
+    return lambda user: {"Authorization": f"Bearer {create_access_token(token_claims(user))}"}
+
+
+@pytest.fixture
+def add_book(database):
+    """add_book(**fields) stores a book with one available copy, fields override its defaults, and returns it"""
+    def add(**fields) -> dict:
+        from bson import ObjectId
+
+        book = {"_id": ObjectId(), "name": "Dune", "description": "d", "author": "Frank Herbert", "genre": "Sci-fi",
+                "total_copies": 1, "available_copies": 1, "status": "AVAILABLE", "is_deleted": False,
+                "created_ts": 1600000000000, "updated_ts": 1600000000000, **fields}
+        asyncio.run(database.books.insert_one(book))
+        return book
+    return add
+
+
+@pytest.fixture
+def run_jobs(database, monkeypatch):
+    """run_jobs() runs the jobs queued in memory since the test started, e.g. the statistics changes"""
+    from api.database.job_queue import MemoryJobStore, job_queue
+
+    monkeypatch.setattr(job_queue, "memory_store", MemoryJobStore(1000))
+    monkeypatch.setattr(job_queue, "durable_store", None)
+
+    monkeypatch.setattr(job_queue, "_wakeup", job_queue._wakeup)
+
+    async def drain():
+        # the wakeup event belongs to the loop it is first awaited in
+        job_queue._wakeup = asyncio.Event()
+        job_queue.start()
+        await job_queue.stop(5)
+
+    return lambda: asyncio.run(drain())
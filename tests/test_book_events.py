@@ -0,0 +1,22 @@
+import asyncio
+
+import orjson
+
+from api.utils.event_hub import book_events
+
+BOOKS = 150
+
+
+def test_bulk_import_sends_one_event_per_batch(client, librarian, auth_headers):
+    body = b"\n".join(orjson.dumps({"name": f"Book {i}", "description": "d", "author": "a", "genre": "g"})
+                      for i in range(BOOKS))
+    subscriber = book_events.subscribe()
+    try:
+        response = asyncio.run(client.post("/books/bulk?batch_size=50", content=body,
+                                           headers={**auth_headers(librarian),
+                                                    "Content-Type": "application/x-ndjson"}))
+    finally:
+        book_events.unsubscribe(subscriber)
+    assert response.json()["inserted"] == BOOKS
+    assert not subscriber.evicted
+    assert [frame.split(b"\n")[1] for frame in subscriber.frames] == [b"event: catalogue"] * 3
@@ -0,0 +1,21 @@
+import asyncio
+
+from api.database.book_log_writer import book_log_writer
+
+
+def test_borrow_is_written_to_the_book_log_by_a_batch_job(database, client, member, add_book, auth_headers,
+                                                          run_jobs, monkeypatch):
+    monkeypatch.setattr(book_log_writer, "_pending", [])
+    book = add_book()
+    asyncio.run(client.post(f"/books/{book['_id']}/borrow-return/true", headers=auth_headers(member)))
+    asyncio.run(client.post(f"/books/{book['_id']}/borrow-return/false", headers=auth_headers(member)))
+
+    # the requests only buffered their events
+    assert asyncio.run(database.book_logs.count_documents({})) == 0
+    asyncio.run(book_log_writer.flush())
+    run_jobs()
+    events = asyncio.run(database.book_logs.find({"member_id": member["_id"]}).sort("_id", 1).to_list(None))
+    assert [event["action"] for event in events] == ["BORROW", "RETURN"]
+    # a job that runs again after its batch was written adds nothing
+    asyncio.run(book_log_writer.write(events))
+    assert asyncio.run(database.book_logs.count_documents({})) == 2
@@ -0,0 +1,43 @@
+import asyncio
+
+
+def get_pages(client, headers, limit):
+    pages, cursor = [], None
+    while True:
+        params = {"limit": limit, **({"after": cursor} if cursor else {})}
+        response = asyncio.run(client.get("/books", params=params, headers=headers))
+        assert response.status_code == 200
+        pages.append(response.json())
+        cursor = pages[-1]["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_cover_the_books_once_in_id_order(client, member, add_book, auth_headers):
+    books = [add_book(name=f"Book {i}") for i in range(5)]
+
+    pages = get_pages(client, auth_headers(member), 2)
+    assert [len(page["books"]) for page in pages] == [2, 2, 1]
+    assert [book["id"] for page in pages for book in page["books"]] == sorted(str(book["_id"]) for book in books)
+    assert pages[-1]["next_cursor"] is None
+
+
+def test_books_added_while_paging_come_after_the_cursor(client, member, add_book, auth_headers):
+    for i in range(3):
+        add_book(name=f"Book {i}")
+    first = asyncio.run(client.get("/books?limit=2", headers=auth_headers(member))).json()
+    added = add_book(name="Book 3")
+
+    rest = asyncio.run(client.get(f"/books?limit=2&after={first['next_cursor']}", headers=auth_headers(member))).json()
+    assert [book["name"] for book in first["books"] + rest["books"]] == ["Book 0", "Book 1", "Book 2", "Book 3"]
+    assert rest["books"][-1]["id"] == str(added["_id"])
+    assert rest["next_cursor"] is None
+
+
+def test_a_tampered_cursor_is_rejected(client, member, add_book, auth_headers):
+    add_book()
+    cursor = asyncio.run(client.get("/books?limit=1", headers=auth_headers(member))).json()["books"][0]["id"]
+
+    for tampered in [cursor[:-1], cursor + "0", "not-a-cursor", "z" * 24]:
+        response = asyncio.run(client.get(f"/books?after={tampered}", headers=auth_headers(member)))
+        assert response.status_code == 422
@@ -0,0 +1,37 @@
+import asyncio
+
+from api.database.overdue_sweeper import DAY_MS, setting
+from api.utils.utils import get_timestamp
+
+BORROWERS = 25
+
+
+def test_concurrent_borrows_of_the_last_copy(database, client, add_user, add_book, auth_headers):
+    members = [add_user("member", f"member{i}") for i in range(BORROWERS)]
+    book = add_book()
+
+    async def borrow_all():
+        return await asyncio.gather(*(client.post(f"/books/{book['_id']}/borrow-return/true",
+                                                  headers=auth_headers(member)) for member in members))
+
+    codes = [response.status_code for response in asyncio.run(borrow_all())]
+    book = asyncio.run(database.books.find_one({"_id": book["_id"]}))
+    assert codes.count(201) == 1
+    assert codes.count(409) == BORROWERS - 1
+    assert book["available_copies"] == 0
+    assert book["status"] == "BORROWED"
+    assert asyncio.run(database.loans.count_documents({"book_id": book["_id"], "status": "ACTIVE"})) == 1
+
+
+def test_late_return_records_the_fine(database, client, member, add_book, auth_headers):
+    book = add_book(available_copies=0, status="BORROWED")
+    # due three days and a bit ago
+    asyncio.run(database.loans.insert_one({"book_id": book["_id"], "member_id": member["_id"], "status": "ACTIVE",
+                                           "borrowed_ts": 0, "due_ts": get_timestamp() - 3 * DAY_MS - 1000}))
+
+    body = asyncio.run(client.post(f"/books/{book['_id']}/borrow-return/false", headers=auth_headers(member))).json()
+    loan = asyncio.run(database.loans.find_one({"member_id": member["_id"]}))
+    assert body["fine"] == 4 * setting.overdue_fine_per_day
+    assert loan["status"] == "RETURNED"
+    assert loan["fine"] == body["fine"]
+    assert asyncio.run(database.books.find_one({"_id": book["_id"]}))["available_copies"] == 1
@@ -0,0 +1,37 @@
+import asyncio
+
+from api.utils.upload import MAX_LINE_BYTES
+
+
+def post_books(client, headers, body, content_type):
+    response = asyncio.run(client.post("/books/bulk", content=body,
+                                       headers={**headers, "Content-Type": content_type}))
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_invalid_csv_rows_are_reported_and_the_others_inserted(database, client, librarian, auth_headers):
+    body = ("name,description,author,genre,total_copies\n"
+            "Dune,d,Frank Herbert,Sci-fi,2\n"
+            "Solaris,d\n"
+            "Emma,d,Jane Austen,Classic,\n"
+            "Ulysses,d,James Joyce,Classic,many\n").encode()
+
+    report = post_books(client, auth_headers(librarian), body, "text/csv")
+    assert (report["inserted"], report["failed"]) == (2, 2)
+    assert [error["row"] for error in report["errors"]] == [2, 4]
+    assert not report["errors_truncated"]
+    books = asyncio.run(database.books.find({}, {"name": 1, "total_copies": 1, "_id": 0}).to_list(None))
+    assert sorted(books, key=lambda book: book["name"]) == [{"name": "Dune", "total_copies": 2},
+                                                            {"name": "Emma", "total_copies": 1}]
+
+
+def test_oversized_and_malformed_ndjson_lines_fail_alone(client, librarian, auth_headers):
+    book = b'{"name": "Dune", "description": "d", "author": "Frank Herbert", "genre": "Sci-fi"}'
+    oversized = b'{"name": "' + b"x" * MAX_LINE_BYTES + b'"}'
+    body = b"\n".join([book, oversized, b"{not json", book])
+
+    report = post_books(client, auth_headers(librarian), body, "application/x-ndjson")
+    assert (report["inserted"], report["failed"]) == (2, 2)
+    assert report["errors"][0] == {"row": 2, "errors": [{"message": f"Row is longer than {MAX_LINE_BYTES} bytes"}]}
+    assert report["errors"][1]["row"] == 3
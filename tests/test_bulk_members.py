@@ -0,0 +1,21 @@
+import asyncio
+
+
+def test_taken_usernames_and_invalid_rows_are_reported(database, client, librarian, member, auth_headers):
+    body = ("username,password,user_type,address,email\n"
+            "alice,Testtest1#,member,street rd,alice@example.com\n"
+            "member,Testtest1#,member,street rd,member2@example.com\n"
+            "bob,Testtest1#,member,street rd,not-an-email\n"
+            "alice,Testtest1#,member,street rd,alice2@example.com\n"
+            "carol,Testtest1#,reader,street rd,carol@example.com\n").encode()
+
+    response = asyncio.run(client.post("/members/bulk", content=body,
+                                       headers={**auth_headers(librarian), "Content-Type": "text/csv"}))
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["inserted"], report["failed"]) == (1, 4)
+    errors = {error["row"]: error["errors"] for error in report["errors"]}
+    assert sorted(errors) == [2, 3, 4, 5]
+    assert errors[2] == errors[4] == [{"message": "username already exist"}]
+    alice = asyncio.run(database.users.find_one({"username": "alice"}))
+    assert alice["email"] == "alice@example.com" and alice["password"] != "Testtest1#"
@@ -0,0 +1,50 @@
+import asyncio
+
+from bson import ObjectId
+
+from api.database.lending import CopyReconciler, serve_holds
+
+
+def test_reconcile_repairs_a_leaked_copy_once_it_is_stable(database, add_book):
+    book = add_book(total_copies=2, available_copies=0, status="BORROWED")
+    # one of the two loans was closed by a return that never put its copy back
+    asyncio.run(database.loans.insert_one({"book_id": book["_id"], "member_id": ObjectId(), "status": "ACTIVE"}))
+    reconciler = CopyReconciler(0)
+
+    assert asyncio.run(reconciler.reconcile()) == 0
+    assert asyncio.run(database.books.find_one({"_id": book["_id"]}))["available_copies"] == 0
+    assert asyncio.run(reconciler.reconcile()) == 1
+    book = asyncio.run(database.books.find_one({"_id": book["_id"]}))
+    assert book["available_copies"] == 1
+    assert book["status"] == "AVAILABLE"
+
+
+def test_added_copies_go_to_the_hold_queue(database, client, librarian, member, add_book, auth_headers):
+    book = add_book(available_copies=0, status="BORROWED")
+    asyncio.run(database.loans.insert_one({"book_id": book["_id"], "member_id": ObjectId(), "status": "ACTIVE"}))
+    asyncio.run(database.holds.insert_one({"book_id": book["_id"], "book_name": "Dune", "member_id": member["_id"],
+                                           "member_name": "member", "created_ts": 1, "status": "WAITING"}))
+
+    response = asyncio.run(client.put(f"/books/{book['_id']}", headers=auth_headers(librarian),
+                                      json={"name": "Dune", "description": "d", "author": "Frank Herbert",
+                                            "genre": "Sci-fi", "total_copies": 2}))
+    assert response.status_code == 200
+    assert asyncio.run(database.books.find_one({"_id": book["_id"]}))["available_copies"] == 0
+    assert asyncio.run(database.holds.find_one({"member_id": member["_id"]}))["status"] == "FULFILLED"
+    assert asyncio.run(database.loans.count_documents({"member_id": member["_id"], "status": "ACTIVE"})) == 1
+
+
+def test_serving_holds_again_completes_an_interrupted_hand_off(database, add_book):
+    book = add_book(total_copies=2, available_copies=1)
+    first, second = ObjectId(), ObjectId()
+    # a hand-off stopped after opening the first holder's loan, before claiming the hold and the copy
+    asyncio.run(database.loans.insert_one({"book_id": book["_id"], "member_id": first, "status": "ACTIVE"}))
+    for created_ts, member_id in enumerate([first, second]):
+        asyncio.run(database.holds.insert_one({"book_id": book["_id"], "book_name": "Dune", "member_id": member_id,
+                                               "created_ts": created_ts, "status": "WAITING"}))
+
+    assert asyncio.run(serve_holds(book["_id"], 1600000000000))
+    assert asyncio.run(database.loans.count_documents({"member_id": second, "status": "ACTIVE"})) == 1
+    assert asyncio.run(database.holds.count_documents({"status": "FULFILLED"})) == 2
+    assert asyncio.run(database.loans.count_documents({"member_id": first, "status": "ACTIVE"})) == 1
+    assert asyncio.run(database.books.find_one({"_id": book["_id"]}))["available_copies"] == 0
@@ -0,0 +1,52 @@
+import asyncio
+
+from bson import ObjectId
+
+from api.database.overdue_sweeper import DAY_MS, OverdueSweeper, setting
+from api.utils.utils import get_timestamp
+
+
+def test_overdue_counter_follows_the_sweeper_and_returns(database, client, librarian, member, add_book,
+                                                         auth_headers, run_jobs):
+    book = add_book(available_copies=0, status="BORROWED")
+    asyncio.run(database.loans.insert_one({"book_id": book["_id"], "member_id": member["_id"], "status": "ACTIVE",
+                                           "borrowed_ts": 0, "due_ts": get_timestamp() - DAY_MS}))
+
+    def overdue():
+        run_jobs()
+        return asyncio.run(client.get("/stats", headers=auth_headers(librarian))).json()["overdue"]
+
+    assert asyncio.run(OverdueSweeper(0, 100).sweep()) == 1
+    assert overdue() == 1
+    asyncio.run(client.post(f"/books/{book['_id']}/borrow-return/false", headers=auth_headers(member)))
+    assert overdue() == 0
+
+
+def test_sweeps_flag_each_overdue_loan_once(database, add_book):
+    book = add_book()
+    now = get_timestamp()
+    asyncio.run(database.loans.insert_many(
+        [{"book_id": book["_id"], "member_id": ObjectId(), "status": "ACTIVE", "due_ts": now - days * DAY_MS}
+         for days in (3, 2, 1, -1)]))
+    sweeper = OverdueSweeper(0, 2)
+
+    assert asyncio.run(sweeper.sweep()) == 3
+    assert asyncio.run(sweeper.sweep()) == 0
+    assert asyncio.run(database.loans.count_documents({"overdue_ts": {"$exists": True}})) == 3
+
+
+def test_overdue_loans_are_listed_with_their_accrued_fine(database, client, librarian, add_book, auth_headers):
+    book = add_book()
+    now = get_timestamp()
+    asyncio.run(database.loans.insert_many(
+        [{"book_id": book["_id"], "member_id": ObjectId(), "status": "ACTIVE", "borrowed_ts": 0,
+          "due_ts": now - days * DAY_MS + 1000} for days in (1, 3, 0)]))
+    headers = auth_headers(librarian)
+
+    first = asyncio.run(client.get("/loans/overdue?limit=1", headers=headers)).json()
+    rest = asyncio.run(client.get(f"/loans/overdue?after={first['next_cursor']}", headers=headers)).json()
+    fines = [loan["fine"] for loan in first["loans"] + rest["loans"]]
+    # every started day late costs a day's fine, the loan due in a second isn't listed
+    assert fines == [3 * setting.overdue_fine_per_day, setting.overdue_fine_per_day]
+    assert rest["next_cursor"] is None
+    assert asyncio.run(client.get("/loans/overdue?after=tampered", headers=headers)).status_code == 400
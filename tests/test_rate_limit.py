@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+
+from api.utils.rate_limit import MAX_USERNAME_BODY_BYTES, MemoryRateLimitBackend, RateLimitMiddleware, parse_rules
+
+
+async def echo_length(scope, receive, send):
+    """App answering with the length of the body it received"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": str(len(body)).encode()})
+
+
+def post_logins(rules, bodies):
+    app = RateLimitMiddleware(echo_length, MemoryRateLimitBackend(100), {"POST /login": parse_rules(rules)})
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return [await client.post("/login", content=body,
+                                      headers={"Content-Type": "application/x-www-form-urlencoded"})
+                    for body in bodies]
+
+    return asyncio.run(run())
+
+
+def test_over_the_limit_gets_429_with_retry_after():
+    responses = post_logins("username:2/60", [b"username=reader&password=x"] * 3 + [b"username=other&password=x"])
+
+    assert [response.status_code for response in responses] == [200, 200, 429, 200]
+    # the sliding window can keep a client out for up to two windows
+    assert 1 <= int(responses[2].headers["retry-after"]) <= 120
+    # the body read for the username still reaches the app
+    assert responses[0].text == str(len(b"username=reader&password=x"))
+
+
+def test_ip_rules_reject_before_the_body_is_read():
+    responses = post_logins("ip:1/60,username:5/60", [b"username=reader"] * 2)
+
+    assert [response.status_code for response in responses] == [200, 429]
+
+
+def test_oversized_body_skips_the_username_rule():
+    body = b"username=reader&password=" + b"x" * MAX_USERNAME_BODY_BYTES
+    responses = post_logins("username:1/60", [body] * 2)
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[1].text == str(len(body))
@@ -0,0 +1,17 @@
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from api.database import connection
+
+
+def test_read_routing_cant_move_primary_only_reads(monkeypatch):
+    monkeypatch.setattr(connection, "_read_collections", {})
+    monkeypatch.setattr(connection.setting, "read_routing",
+                        {"get_all_books": "secondary", connection.CACHE_FILL_READS: "secondary",
+                         "search_books": "primary"})
+
+    assert isinstance(connection.read_collection("books", "get_all_books").options["read_preference"], Primary)
+    assert isinstance(connection.read_collection("books", connection.CACHE_FILL_READS).options["read_preference"],
+                      Primary)
+    assert isinstance(connection.read_collection("books", "search_books").options["read_preference"], Primary)
+    assert isinstance(connection.read_collection("books", "stream_all_books").options["read_preference"],
+                      SecondaryPreferred)
@@ -0,0 +1,62 @@
+import asyncio
+from email.utils import formatdate
+
+import pytest
+
+from api.utils.response_cache import MemoryCacheBackend, RedisCacheBackend, ResponseCache, response_cache
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def redis_backend(server=None):
+    return RedisCacheBackend(None, client=fakeredis.FakeAsyncRedis(server=server or fakeredis.FakeServer()))
+
+
+@pytest.mark.parametrize("backend", [lambda: MemoryCacheBackend(100), redis_backend], ids=["memory", "redis"])
+def test_store_hit_and_invalidate(backend):
+    async def run():
+        cache = ResponseCache(backend(), 30, {})
+        miss = await cache.lookup("books", "get_all_books", 100, None)
+        await cache.store(miss, b"page")
+        hit = await cache.lookup("books", "get_all_books", 100, None)
+        await cache.invalidate("books")
+        invalidated = await cache.lookup("books", "get_all_books", 100, None)
+        return miss.body, hit.body, invalidated.body, cache.stats()
+
+    miss, hit, invalidated, stats = asyncio.run(run())
+    assert (miss, hit, invalidated) == (None, b"page", None)
+    assert stats["hits"] == 1 and stats["misses"] == 2
+
+
+def test_redis_invalidation_reaches_every_worker():
+    async def run():
+        server = fakeredis.FakeServer()
+        worker, other_worker = ResponseCache(redis_backend(server), 30, {}), ResponseCache(redis_backend(server), 30, {})
+        await worker.store(await worker.lookup("members", "get_members_list"), b"members")
+        shared = await other_worker.lookup("members", "get_members_list")
+        await other_worker.invalidate("members")
+        return shared.body, (await worker.lookup("members", "get_members_list")).body
+
+    assert asyncio.run(run()) == (b"members", None)
+
+
+def test_cached_book_keeps_its_last_modified(client, librarian, add_book, auth_headers, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", redis_backend())
+    book = add_book(updated_ts=1700000000000)
+    headers = auth_headers(librarian)
+
+    async def run():
+        first = await client.get(f"/books/{book['_id']}", headers=headers)
+        cached = await client.get(f"/books/{book['_id']}", headers=headers)
+        await client.put(f"/books/{book['_id']}", headers=headers,
+                         json={"name": "Dune Messiah", "description": "d", "author": "Frank Herbert",
+                               "genre": "Sci-fi", "total_copies": 1})
+        updated = await client.get(f"/books/{book['_id']}", headers=headers)
+        return first, cached, updated
+
+    first, cached, updated = asyncio.run(run())
+    assert first.headers["last-modified"] == formatdate(1700000000, usegmt=True)
+    assert cached.json() == first.json()
+    assert cached.headers["last-modified"] == first.headers["last-modified"]
+    assert updated.json()["book"]["name"] == "Dune Messiah"
+    assert updated.headers["last-modified"] != first.headers["last-modified"]
@@ -0,0 +1,25 @@
+import asyncio
+
+
+def test_unfiltered_search_counts_from_the_statistics_counters(database, client, member, add_book, auth_headers):
+    books = [add_book(name=f"Book {i}", genre="Sci-fi" if i % 2 else "Fantasy") for i in range(3)]
+    asyncio.run(database.stats.insert_many([
+        {"dimension": "status", "value": "AVAILABLE", "count": 3},
+        {"dimension": "genre", "value": "Fantasy", "count": 2},
+        {"dimension": "genre", "value": "Sci-fi", "count": 1},
+        {"dimension": "author", "value": "Frank Herbert", "count": 3},
+    ]))
+
+    body = asyncio.run(client.get("/books/search?limit=2", headers=auth_headers(member))).json()
+    assert [book["id"] for book in body["books"]] == [str(book["_id"]) for book in books[:2]]
+    assert body["total"] == 3
+    assert body["facets"]["genre"] == [{"value": "Fantasy", "count": 2}, {"value": "Sci-fi", "count": 1}]
+
+
+def test_filtered_search_counts_the_matches(client, member, add_book, auth_headers):
+    for i in range(3):
+        add_book(name=f"Book {i}", genre="Sci-fi" if i % 2 else "Fantasy")
+
+    body = asyncio.run(client.get("/books/search?genre=Fantasy", headers=auth_headers(member))).json()
+    assert body["total"] == 2
+    assert body["facets"]["genre"] == [{"value": "Fantasy", "count": 2}]
@@ -0,0 +1,31 @@
+import asyncio
+
+from api.auth.token_revocation import TokenRevocations
+from api.utils.utils import get_timestamp
+
+
+def test_renaming_a_member_revokes_the_tokens_issued_before(monkeypatch, database, client, librarian, member,
+                                                             auth_headers):
+    from api.auth import authenticate
+
+    monkeypatch.setattr(authenticate.setting, "auth_mode", authenticate.AUTH_MODE_CLAIMS)
+    headers = auth_headers(member)
+    assert asyncio.run(client.get("/books", headers=headers)).status_code == 200
+
+    response = asyncio.run(client.put(f"/members/{member['_id']}", headers=auth_headers(librarian),
+                                      json={"username": "renamed", "user_type": "member"}))
+    assert response.status_code == 200
+    assert asyncio.run(client.get("/books", headers=headers)).status_code == 401
+    renamed = asyncio.run(database.users.find_one({"_id": member["_id"]}))
+    assert renamed["token_version"] == 1
+    assert asyncio.run(client.get("/books", headers=auth_headers(renamed))).status_code == 200
+
+
+def test_poll_picks_up_the_revocations_of_other_workers(database, member):
+    revocations = TokenRevocations(database.users, 5)
+    asyncio.run(database.users.update_one({"_id": member["_id"]},
+                                          {"$set": {"token_version": 2, "token_version_ts": get_timestamp()}}))
+
+    asyncio.run(revocations.poll())
+    assert revocations.is_revoked(str(member["_id"]), 1)
+    assert not revocations.is_revoked(str(member["_id"]), 2)
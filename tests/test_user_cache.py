@@ -0,0 +1,40 @@
+import asyncio
+
+from api.auth import user_cache as user_cache_module
+from api.auth.user_cache import UserCache
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(user_cache_module.time, "monotonic", lambda: now[0])
+    cache = UserCache(10, 60)
+    cache.set("member", {"username": "member"})
+
+    now[0] += 59
+    assert cache.get("member") == {"username": "member"}
+    now[0] += 2
+    assert cache.get("member") is None
+    assert cache.stats() == {"size": 0, "hits": 1, "misses": 1}
+
+
+def test_the_least_recently_used_entry_is_evicted():
+    cache = UserCache(2, 60)
+    cache.set("a", {"username": "a"})
+    cache.set("b", {"username": "b"})
+    cache.get("a")
+    cache.set("c", {"username": "c"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+
+
+def test_deleting_a_member_drops_the_cached_user(client, librarian, member, auth_headers):
+    from api.auth.authenticate import user_cache
+
+    assert asyncio.run(client.get("/books", headers=auth_headers(member))).status_code == 200
+    assert user_cache.get("member")["_id"] == member["_id"]
+
+    response = asyncio.run(client.delete(f"/members/{member['_id']}", headers=auth_headers(librarian)))
+    assert response.status_code == 200
+    assert user_cache.get("member") is None
+    assert asyncio.run(client.get("/books", headers=auth_headers(member))).status_code == 401